@@ -0,0 +1,206 @@
+# Junction x sample count matrix from per-sample junction files (STAR SJ.out.tab or BED)
+# Files are read in batches, one open file at a time, and spilled as per-contig segments;
+# each contig is then merged by coordinate in its own worker and streamed into one CSR matrix.
+import os
+import numpy as np
+
+from tools import Multi
+
+record_dtype = np.dtype([("start",np.int64),("end",np.int64),("strand",np.int8),("sample",np.int32),("count",np.int32)])
+strands = np.array([".","+","-"])
+
+def get_args(argv=None):
+    import argparse
+    parser = argparse.ArgumentParser()
+    parser.add_argument("-i","--input",default=None,nargs="+",
+                        help="Junction files, one per sample (sample names are the file names without the suffix).")
+    parser.add_argument("-f","--file_list",default=None,
+                        help="Tab-separated file of sample names and junction file paths, for cohorts too large for the command line.")
+    parser.add_argument("-o","--output_prefix",default="splicedice",
+                        help="Path and file prefix for {output_prefix}.counts.csr.npz and .counts.csr.intervals.tsv.")
+    parser.add_argument("--format",default="auto",choices=["auto","star","bed"],
+                        help="Junction file format (auto: BED for .bed and .bed.gz files, otherwise STAR SJ.out.tab).")
+    parser.add_argument("--star_counts",default="unique",choices=["unique","multi","total"],
+                        help="Reads to count from STAR files: uniquely mapped, multi-mapped or both.")
+    parser.add_argument("--batch_files",default=256,type=int,
+                        help="Number of junction files read by each worker task.")
+    parser.add_argument("--tmp_dir",default=None,
+                        help="Directory for intermediate segments (default {output_prefix}.aggregate.tmp, removed afterwards).")
+    Multi.add_arguments(parser,backend=False)
+    return parser.parse_args(argv)
+
+def sample_name(filename):
+    name = os.path.basename(filename)
+    for suffix in (".gz",".tab",".out",".SJ",".bed","SJ"):
+        if name.endswith(suffix) and len(name) > len(suffix):
+            name = name[:-len(suffix)]
+    return name
+
+def get_files(args):
+    files = []
+    if args.file_list:
+        with open(args.file_list) as tsv:
+            for line in tsv:
+                row = line.rstrip('\n').split('\t')
+                if len(row) > 1:
+                    files.append((row[0],row[1]))
+    for filename in args.input or []:
+        files.append((sample_name(filename),filename))
+    return files
+
+def read_junctions(filename,file_format="auto",star_counts="unique"):
+    # Contig names and intron records (1-based first and last intron base) of one junction file
+    import gzip
+    opener = gzip.open if filename.endswith(".gz") else open
+    with opener(filename,'rb') as junction_file:
+        data = junction_file.read()
+    while data.startswith((b"track",b"browser",b"#")):
+        data = data[data.find(b"\n")+1:] if b"\n" in data else b""
+    if not data.strip():
+        return np.zeros(0,dtype="S1"),np.zeros(0,dtype=record_dtype)
+    n_columns = len(data[:data.find(b"\n")].split()) if b"\n" in data else len(data.split())
+    tokens = data.split()
+    columns = {k:np.array(tokens[k::n_columns]) for k in (0,1,2,3,4,5,6,7,10) if k < n_columns}
+    records = np.zeros(len(columns[0]),dtype=record_dtype)
+    if file_format == "bed" or (file_format == "auto" and filename.endswith((".bed",".bed.gz"))):
+        start,end = columns[1].astype(np.int64) + 1,columns[2].astype(np.int64)
+        if n_columns >= 12:
+            # BED12 junctions span the anchors; the intron lies between the two blocks
+            sizes = np.array([s.split(b",")[:2] for s in columns[10]]).astype(np.int64)
+            start,end = start + sizes[:,0],end - sizes[:,1]
+        records["start"],records["end"] = start,end
+        records["count"] = columns[4].astype(float).astype(np.int32)
+        records["strand"] = np.select([columns[5] == b"+",columns[5] == b"-"],[1,2],0)
+    else:
+        records["start"],records["end"] = columns[1].astype(np.int64),columns[2].astype(np.int64)
+        records["strand"] = columns[3].astype(np.int8)
+        if star_counts == "unique":
+            records["count"] = columns[6].astype(np.int32)
+        elif star_counts == "multi":
+            records["count"] = columns[7].astype(np.int32)
+        else:
+            records["count"] = columns[6].astype(np.int32) + columns[7].astype(np.int32)
+    return columns[0],records
+
+def batch_items(info):
+    files,batch_files = info
+    for b,start in enumerate(range(0,len(files),batch_files)):
+        yield b,[(s,files[s][1]) for s in range(start,min(start+batch_files,len(files)))]
+
+def spill_batch(item,info):
+    # One sorted segment file per contig for a batch of samples
+    b,batch = item
+    tmp_dir,file_format,star_counts = info
+    contigs,records = [],[]
+    for s,filename in batch:
+        names,sample_records = read_junctions(filename,file_format,star_counts)
+        sample_records["sample"] = s
+        contigs.append(names)
+        records.append(sample_records)
+    contigs,records = np.concatenate(contigs),np.concatenate(records)
+    names,inverse = np.unique(contigs,return_inverse=True)
+    order = np.lexsort((records["sample"],records["strand"],records["end"],records["start"],inverse))
+    bounds = np.searchsorted(inverse[order],np.arange(len(names)+1))
+    segments = []
+    for k,name in enumerate(names):
+        filename = os.path.join(tmp_dir,f"batch{b}.{k}.npy")
+        np.save(filename,records[order[bounds[k]:bounds[k+1]]])
+        segments.append((name.decode(),filename))
+    return b,segments
+
+def contig_items(info):
+    yield from info
+
+def merge_contig(item,info):
+    # Junction rows of one contig from all batch segments, in (start,end,strand) order with samples in order
+    c,segment_files = item
+    tmp_dir = info
+    records = np.concatenate([np.load(filename) for filename in segment_files])
+    order = np.lexsort((records["sample"],records["strand"],records["end"],records["start"]))
+    records = records[order]
+    new_entry = np.ones(len(records),dtype=bool)
+    new_row = np.ones(len(records),dtype=bool)
+    new_row[1:] = ((records["start"][1:] != records["start"][:-1]) | (records["end"][1:] != records["end"][:-1])
+                   | (records["strand"][1:] != records["strand"][:-1]))
+    new_entry[1:] = new_row[1:] | (records["sample"][1:] != records["sample"][:-1])
+    entries = np.flatnonzero(new_entry)
+    counts = np.add.reduceat(records["count"],entries) if len(entries) else np.zeros(0,dtype=np.int32)
+    rows = np.flatnonzero(new_row)
+    filename = os.path.join(tmp_dir,f"contig{c}.npz")
+    np.savez(filename,start=records["start"][rows],end=records["end"][rows],strand=records["strand"][rows],
+             lengths=np.diff(np.append(np.searchsorted(entries,rows),len(entries))),
+             indices=records["sample"][entries],data=counts.astype(np.int32))
+    for segment in segment_files:
+        os.remove(segment)
+    return c,filename
+
+def write_array(archive,name,dtype,length,pieces):
+    # Stream a 1-d array into an .npz member piece by piece
+    with archive.open(f"{name}.npy",'w',force_zip64=True) as member:
+        np.lib.format.write_array_header_2_0(member,{"descr":np.lib.format.dtype_to_descr(np.dtype(dtype)),
+                                                     "fortran_order":False,"shape":(length,)})
+        for piece in pieces:
+            member.write(np.ascontiguousarray(piece,dtype=dtype).tobytes())
+
+def write_matrix(output_prefix,samples,contigs,contig_files):
+    import zipfile
+    filename = f"{output_prefix}.counts.csr.npz"
+    sizes = []
+    for contig_file in contig_files:
+        with np.load(contig_file) as contig:
+            sizes.append((len(contig["lengths"]),len(contig["indices"])))
+    n_rows,nnz = sum(rows for rows,entries in sizes),sum(entries for rows,entries in sizes)
+    def pieces(key):
+        for contig_file in contig_files:
+            with np.load(contig_file) as contig:
+                yield contig[key]
+    def indptr():
+        yield np.zeros(1,dtype=np.int64)
+        offset = 0
+        for lengths in pieces("lengths"):
+            yield offset + np.cumsum(lengths)
+            offset += int(lengths.sum())
+    with zipfile.ZipFile(filename,'w',allowZip64=True) as archive:
+        write_array(archive,"indptr",np.int64,n_rows+1,indptr())
+        write_array(archive,"indices",np.int32,nnz,pieces("indices"))
+        write_array(archive,"data",np.int32,nnz,pieces("data"))
+        with archive.open("n_samples.npy",'w') as member:
+            np.lib.format.write_array(member,np.array(len(samples)))
+    tab = '\t'
+    with open(f"{filename[:-4]}.intervals.tsv",'w') as index:
+        index.write(f"splice_interval\t{tab.join(samples)}\n")
+        for contig,contig_file in zip(contigs,contig_files):
+            with np.load(contig_file) as rows:
+                index.write("".join(f"{contig}:{start}-{end}:{strand}\n" for start,end,strand in
+                                    zip(rows["start"].tolist(),rows["end"].tolist(),strands[rows["strand"]].tolist())))
+    return filename,n_rows,nnz
+
+def main(argv=None):
+    import shutil
+    args = get_args(argv)
+    files = get_files(args)
+    if not files:
+        exit("aggregate needs junction files (-i or -f)")
+    samples = [sample for sample,filename in files]
+    tmp_dir = args.tmp_dir or f"{args.output_prefix}.aggregate.tmp"
+    os.makedirs(tmp_dir,exist_ok=True)
+
+    print(f"Reading {len(files)} junction files...")
+    segments = {}
+    for b,batch_segments in Multi.run(batch_items,(files,args.batch_files),spill_batch,
+                                      (tmp_dir,args.format,args.star_counts),args.n_threads):
+        for contig,filename in batch_segments:
+            segments.setdefault(contig,[]).append((b,filename))
+    contigs = sorted(segments)
+
+    print(f"Merging {len(contigs)} contigs...")
+    items = [(c,[filename for b,filename in sorted(segments[contig])]) for c,contig in enumerate(contigs)]
+    contig_files = dict(Multi.run(contig_items,items,merge_contig,tmp_dir,args.n_threads))
+
+    print("Writing...")
+    filename,n_rows,nnz = write_matrix(args.output_prefix,samples,contigs,[contig_files[c] for c in range(len(contigs))])
+    shutil.rmtree(tmp_dir)
+    print(f"Wrote {filename} ({n_rows} junctions x {len(samples)} samples, {nnz} counts)")
+
+if __name__ == "__main__":
+    main()
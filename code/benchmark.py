@@ -0,0 +1,183 @@
+# Timing for splicedice startup and pipeline stages
+import os
+import sys
+import time
+import subprocess
+
+code_dir = os.path.dirname(os.path.abspath(__file__))
+entry = os.path.join(code_dir,"splicedice.py")
+
+def get_args(argv=None):
+    import argparse
+    parser = argparse.ArgumentParser()
+    parser.add_argument("-p","--ps_table",default=None,
+                        help="PS table to benchmark on (a synthetic table is written when omitted).")
+    parser.add_argument("-m","--manifest",default=None,
+                        help="Manifest for the PS table (required with -p).")
+    parser.add_argument("-o","--output_prefix",default="splicedice_benchmark",
+                        help="Path and file prefix for benchmark inputs, outputs and the .benchmark.tsv report.")
+    parser.add_argument("-n","--n_threads",default="4",
+                        help="Passed through to each mode.")
+    parser.add_argument("-r","--repeats",default=3,type=int,
+                        help="Number of repeats for startup timings (the fastest is reported).")
+    parser.add_argument("--rows",default=20000,type=int,
+                        help="Number of intervals in the synthetic table.")
+    parser.add_argument("--samples",default=40,type=int,
+                        help="Number of samples in the synthetic table (split over 4 groups).")
+    parser.add_argument("--seed",default=0,type=int,
+                        help="Random seed for the synthetic table.")
+    return parser.parse_args(argv)
+
+def synthetic_table(prefix,n_rows,n_samples,seed=0):
+    import numpy as np
+    rng = np.random.default_rng(seed)
+    groups = [f"group{i}" for i in range(4)]
+    labels = [groups[i % len(groups)] for i in range(n_samples)]
+    samples = [f"sample{i}" for i in range(n_samples)]
+    with open(f"{prefix}.manifest.tsv",'w') as tsv:
+        for sample,label in zip(samples,labels):
+            tsv.write(f"{sample}\t{label}\n")
+    shift = np.array([0.25 if label == groups[0] else 0 for label in labels])
+    tab = '\t'
+    with open(f"{prefix}.ps.tsv",'w') as tsv:
+        tsv.write(f"cluster\t{tab.join(samples)}\n")
+        for start in range(0,n_rows,1000):
+            m = min(1000,n_rows-start)
+            base = rng.uniform(0.05,0.7,size=(m,1))
+            means = base + shift * (rng.random((m,1)) < 0.2)
+            values = rng.beta(means*20,(1-means)*20)
+            values[rng.random(values.shape) < 0.05] = np.nan
+            for i,row in enumerate(values):
+                left = 1000 + (start+i)*100
+                tsv.write(f"chr{(start+i) % 22 + 1}:{left}-{left+50}:+\t{tab.join(f'{x:.4f}' for x in row)}\n")
+    return f"{prefix}.ps.tsv",f"{prefix}.manifest.tsv"
+
+def time_command(command,repeats=1,output=None):
+    # Fastest of the repeats; the printed output of the last run is added to output if given
+    times = []
+    for i in range(repeats):
+        start = time.perf_counter()
+        result = subprocess.run(command,check=True,stdout=subprocess.PIPE if output is not None else subprocess.DEVNULL,text=True)
+        times.append(time.perf_counter()-start)
+    if output is not None:
+        output.append(result.stdout)
+    return min(times)
+
+def startup_times(repeats):
+    python = sys.executable
+    commands = [("startup: python",[python,"-c","pass"]),
+                ("startup: splicedice.py --help",[python,entry,"--help"]),
+                ("startup: compare --help",[python,entry,"compare","--help"]),
+                ("startup: plot --help",[python,entry,"plot","--help"]),
+                ("import: signature",[python,"-c",f"import sys; sys.path.insert(0,{code_dir!r}); import signature"]),
+                ("import: scipy.stats",[python,"-c","import scipy.stats"])]
+    return [(name,time_command(command,repeats),"s") for name,command in commands]
+
+def stage_times(ps_table,manifest,prefix,n_threads):
+    python = sys.executable
+    stages = [("stage: compare",["compare","-p",ps_table,"-m",manifest,"-o",prefix]),
+              ("stage: fit_beta",["fit_beta","-s",f"{prefix}.sig.tsv","-p",ps_table,"-m",manifest,"-o",prefix]),
+              ("stage: query",["query","-b",f"{prefix}.beta.tsv","-p",ps_table,"-m",manifest,"-o",prefix])]
+    results = []
+    for name,command in stages:
+        output = []
+        results.append((name,time_command([python,entry]+command+["-n",str(n_threads)],output=output),"s"))
+        if name == "stage: compare":
+            results.extend(prefilter_rate(output[0]))
+    return results
+
+def prefilter_rate(output):
+    # Share of intervals that pass the delta prefilter and reach the rank-sum kernel
+    for line in output.splitlines():
+        if line.startswith("Delta prefilter:"):
+            ranked,tested = line.split(":")[1].split(" intervals")[0].split(" of ")
+            return [("compare: prefilter pass rate",int(ranked) / max(1,int(tested)),"fraction")]
+    return []
+
+def read_values(filename):
+    import numpy as np
+    with open(filename) as tsv:
+        tsv.readline()
+        rows = {line.split('\t',1)[0]:line.rstrip('\n').split('\t')[1:] for line in tsv}
+    return {key:np.array([float(x) for x in row]) for key,row in rows.items()}
+
+def dtype_accuracy(ps_table,manifest,prefix,n_threads,dtypes=("float32","float16","uint16")):
+    # Time and accuracy cost of each storage type against float64
+    import numpy as np
+    python = sys.executable
+    results = []
+    reference = read_values(f"{prefix}.sig.tsv")
+    reference_pvals = read_values(f"{prefix}.pvals.tsv")
+    for dtype in dtypes:
+        out = f"{prefix}.{dtype}"
+        seconds = time_command([python,entry,"compare","-p",ps_table,"-m",manifest,"-o",out,"-n",str(n_threads),"--dtype",dtype])
+        results.append((f"dtype {dtype}: compare",seconds,"s"))
+        sig = read_values(f"{out}.sig.tsv")
+        common = [k for k in reference if k in sig]
+        errors = np.array([np.nanmax(np.abs(sig[k]-reference[k])[2::4]) for k in common] or [np.nan])
+        results.append((f"dtype {dtype}: max delta error",float(np.nanmax(errors)),"PS"))
+        results.append((f"dtype {dtype}: sig intervals changed",len(set(sig) ^ set(reference)),"intervals"))
+        seconds = time_command([python,entry,"query","-b",f"{prefix}.beta.tsv","-p",ps_table,"-o",out,"-n",str(n_threads),"--dtype",dtype])
+        results.append((f"dtype {dtype}: query",seconds,"s"))
+        pvals = read_values(f"{out}.pvals.tsv")
+        log_errors = [np.nanmax(np.abs(np.log10(pvals[k])-np.log10(reference_pvals[k]))) for k in reference_pvals]
+        results.append((f"dtype {dtype}: max query log10 p error",float(np.nanmax(log_errors)),"log10"))
+    return results
+
+def store_accuracy(ps_table,prefix,n_threads):
+    # A float32 .ps.npy store should query exactly like the .ps.tsv read as float32
+    import numpy as np
+    python = sys.executable
+    out = f"{prefix}.store"
+    time_command([python,entry,"store","-p",ps_table,"-o",out])
+    seconds = time_command([python,entry,"query","-b",f"{prefix}.beta.tsv","-p",f"{out}.ps.npy","-o",out,"-n",str(n_threads)])
+    pvals = read_values(f"{out}.pvals.tsv")
+    reference_pvals = read_values(f"{prefix}.float32.pvals.tsv")
+    changed = sum(int((~np.isclose(pvals[k],reference_pvals[k],rtol=0,atol=0,equal_nan=True)).sum()) for k in reference_pvals)
+    return [("store float32: query",seconds,"s"),
+            ("store float32: query p-values changed",changed,"p-values")]
+
+def catalog_round_trip(ps_table):
+    # Interval names must format back unchanged from their catalog IDs, also when names without the
+    # contig:left-right:strand form (kept as they are) come in between
+    from tools import Catalog,Table
+    intervals = Table(ps_table).get_intervals()
+    names = []
+    for k,interval in enumerate(intervals):
+        names.append(interval)
+        if k % 100 == 0:
+            contig = interval.rsplit(":",2)[0]
+            names.extend([f"{contig}x:{k}-{k}",f"{contig}y:a{k}-b:+",f"junction{k}"])
+    catalog = Catalog()
+    formatted = catalog.format(catalog.add(names))
+    return [("catalog: names changed by interning",sum(a != b for a,b in zip(formatted,names)),"names")]
+
+def write_report(prefix,results):
+    with open(f"{prefix}.benchmark.tsv",'w') as tsv:
+        tsv.write("measurement\tvalue\tunit\n")
+        for name,value,unit in results:
+            tsv.write(f"{name}\t{value}\t{unit}\n")
+
+def main(argv=None):
+    args = get_args(argv)
+    if args.ps_table:
+        ps_table,manifest = args.ps_table,args.manifest
+    else:
+        print("Writing synthetic table...")
+        ps_table,manifest = synthetic_table(args.output_prefix,args.rows,args.samples,args.seed)
+    results = []
+    print("Timing startup...")
+    results.extend(startup_times(args.repeats))
+    print("Timing stages...")
+    results.extend(stage_times(ps_table,manifest,args.output_prefix,args.n_threads))
+    print("Timing storage types...")
+    results.extend(dtype_accuracy(ps_table,manifest,args.output_prefix,args.n_threads))
+    print("Checking binary store queries...")
+    results.extend(store_accuracy(ps_table,args.output_prefix,args.n_threads))
+    results.extend(catalog_round_trip(ps_table))
+    for name,value,unit in results:
+        print(f"{name:<40}{value:.4g} {unit}")
+    write_report(args.output_prefix,results)
+
+if __name__ == "__main__":
+    main()
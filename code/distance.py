@@ -0,0 +1,72 @@
+# Sample x sample distance matrix over PS values, for QC and clustering
+# Row blocks are streamed to worker processes that add their Gram products to shared sums (tools.Distance);
+# the matrix, the pairwise observed counts and an optional hierarchical clustering order go to {output_prefix}.dist.npz
+import numpy as np
+
+from tools import Distance,Multi,Table
+
+def get_args(argv=None):
+    import argparse
+    parser = argparse.ArgumentParser()
+    parser.add_argument("-p","--ps_table",required=True,
+                        help="PS table (.ps.tsv or a binary .ps.npy / .ps.csr.npz store).")
+    parser.add_argument("-o","--output_prefix",default="splicedice",
+                        help="Path and file prefix for {output_prefix}.dist.npz.")
+    parser.add_argument("--metric",default="pearson",choices=Distance.metrics,
+                        help="pearson: 1 - correlation over the intervals observed in both samples; euclidean: distance over "
+                             "those intervals, scaled up to all intervals.")
+    parser.add_argument("--linkage",default=None,choices=["average","complete","single","weighted","ward"],
+                        help="Also cluster the samples hierarchically with this linkage and store the leaf order for plot.py.")
+    parser.add_argument("--tile_size",default=1024,type=int,
+                        help="Samples per tile of the shared sums; workers lock one tile pair at a time.")
+    Multi.add_arguments(parser)
+    return parser.parse_args(argv)
+
+def block_distance(item,info):
+    i,intervals,values = item
+    info.add(Table.load(values))
+    return i,len(intervals)
+
+def cluster_order(distance,method="average"):
+    from scipy.cluster import hierarchy
+    from scipy.spatial.distance import squareform
+    # Pairs without enough shared intervals are placed at the largest distance
+    missing = np.isnan(distance)
+    filled = np.where(missing,np.nanmax(distance) if not missing.all() else 0,distance).astype(float)
+    np.fill_diagonal(filled,0)
+    tree = hierarchy.linkage(squareform(filled,checks=False),method=method)
+    return hierarchy.leaves_list(tree),tree
+
+def write_distance(output_prefix,samples,metric,distance,counts,order=None,tree=None):
+    arrays = {"samples":np.array(samples),"metric":np.array(metric),"distance":distance,"observed":counts}
+    if order is not None:
+        arrays["order"] = order
+        arrays["linkage"] = tree
+    filename = f"{output_prefix}.dist.npz"
+    np.savez(filename,**arrays)
+    return filename
+
+def main(argv=None):
+    args = get_args(argv)
+    ps_table = Table(args.ps_table)
+    samples = ps_table.get_samples()
+    print(f"Computing {args.metric} distances between {len(samples)} samples...")
+    distance = Distance(len(samples),args.metric,args.tile_size)
+    try:
+        n_rows = sum(rows for i,rows in Multi.run(ps_table.get_blocks,None,block_distance,distance,args.n_threads,
+                                                   backend=args.backend))
+        matrix,counts = distance.distances(n_rows)
+    finally:
+        distance.close()
+    n_missing = int(np.isnan(matrix[np.triu_indices(len(samples),1)]).sum())
+    if n_missing:
+        print(f"{n_missing} sample pairs have too few shared intervals for a distance")
+    order = tree = None
+    if args.linkage:
+        print(f"Clustering with {args.linkage} linkage...")
+        order,tree = cluster_order(matrix,args.linkage)
+    filename = write_distance(args.output_prefix,samples,args.metric,matrix,counts,order,tree)
+    print(f"Wrote {filename} ({len(samples)} x {len(samples)} over {n_rows} intervals)")
+
+if __name__ == "__main__":
+    main()
@@ -1,10 +1,7 @@
-import matplotlib.pyplot as plt
-import matplotlib.patches as patches
-import matplotlib.colors as mcolors
-from scipy import stats
+# matplotlib is imported where figures are drawn, so that --help and argument errors don't wait for it
 import numpy as np
 import time
-from tools import Table, Manifest
+from tools import Table, Manifest, RandomizedPCA
 
 def get_color(x):
     if x < 0.5:
@@ -44,32 +41,30 @@ class PvalMatrix:
     
     def read_pvals(self,pvals,groups,threshold=0.05):
         with open(pvals) as tsv:
-            header = tsv.readline().split('\t')
-            group_indices = {}
-            for i,name in enumerate(header):
-                if name in groups:
-                    if groups[name] not in group_indices:
-                        group_indices[groups[name]] = [i]
-                    else:
-                        group_indices[groups[name]].append(i)
-            group_counts = []
-            group_props = []
-            ylabels = []
-            for line in tsv:
-                row = line.rstrip().split('\t')
-                if "Tumor" in row[0]:
-                    continue
-                counts = []
-                props = []
-                for index in group_indices.values():
-                    counts.append(len([i for i in index if float(row[i])<threshold]))
-                    props.append(counts[-1]/len(index))
-                ylabels.append(row[0])
-                group_counts.append(counts)
-                group_props.append(props)
+            header = tsv.readline().rstrip('\n').split('\t')
+            lines = [line for line in tsv if "Tumor" not in line.split('\t',1)[0]]
+        group_indices = {}
+        for i,name in enumerate(header):
+            if name in groups:
+                if groups[name] not in group_indices:
+                    group_indices[groups[name]] = [i]
+                else:
+                    group_indices[groups[name]].append(i)
+        ylabels = [line.split('\t',1)[0] for line in lines]
+        columns = sorted(i for index in group_indices.values() for i in index)
+        matrix = np.loadtxt(lines,delimiter='\t',usecols=columns,ndmin=2) if lines else np.zeros((0,len(columns)))
+        position = {c:j for j,c in enumerate(columns)}
+        hits = matrix < threshold
+        group_counts = np.zeros((len(ylabels),len(group_indices)),dtype=int)
+        for k,index in enumerate(group_indices.values()):
+            group_counts[:,k] = hits[:,[position[i] for i in index]].sum(axis=1)
+        sizes = np.array([len(index) for index in group_indices.values()])
+        group_props = group_counts / sizes
         return header[1:],ylabels[::-1],group_indices,group_counts[::-1],group_props[::-1]
 
-    def plot_table(self,filename,color=get_color,text=get_text_color):
+    def plot_table(self,filename,color=get_color,text=get_text_color,max_text_cells=2500,rasterize_cells=10000):
+        import matplotlib.pyplot as plt
+        import matplotlib.colors as mcolors
         pw = .6 * len(self.xlabels)
         ph = .32 * len(self.ylabels)
         w = pw + 2.5
@@ -82,16 +77,18 @@ class PvalMatrix:
         colorbar.tick_params(left=False,right=True,bottom=False,top=False,
                              labelleft=False,labelright=True,labelbottom=False,labeltop=False)
         colorbar.set_yticks([0,0.5,1],['0%','50%','100%'])
-        for i in range(100):
-            p = i/100
-            rectangle = patches.Rectangle([0,p],1,.01,lw=0,fc=color(p))
-            colorbar.add_patch(rectangle)
-        for i in range(len(self.ylabels)):
-            for j in range(len(self.xlabels)):
-                p = self.group_props[i][j]
-                rectangle = patches.Rectangle([j+.5,i+.5],1,1,lw=0.5,ec='black',fc=color(p))
-                panel.add_patch(rectangle)
-                panel.text(j+1,i+1,self.group_counts[i][j],color=text(p),va='center',ha='center')
+        cmap = mcolors.ListedColormap([color(i/255) for i in range(256)])
+        colorbar.imshow(np.linspace(0,1,100)[:,None],cmap=cmap,vmin=0,vmax=1,aspect='auto',
+                        origin='lower',extent=(0,1,0,1))
+        n_cells = self.group_props.size
+        panel.pcolormesh(np.arange(len(self.xlabels)+1)+.5,np.arange(len(self.ylabels)+1)+.5,
+                         self.group_props,cmap=cmap,vmin=0,vmax=1,
+                         edgecolors='black' if n_cells <= max_text_cells else 'face',linewidth=0.5,
+                         rasterized=n_cells > rasterize_cells)
+        if n_cells <= max_text_cells:
+            for i,j in np.ndindex(self.group_props.shape):
+                p = self.group_props[i,j]
+                panel.text(j+1,i+1,self.group_counts[i,j],color=text(p),va='center',ha='center')
         panel.set_xlim(0.5,len(self.xlabels)+.5)
         panel.set_ylim(0.5,len(self.ylabels)+.5)
         plt.savefig(f"{filename}_matchtable.png")
@@ -162,6 +159,7 @@ class ColorBox:
             return default
 
     def get_light(self,label,default="lightgray"):
+        import matplotlib.colors as mcolors
         if label in self.labels:
             color = self.labels[label]
             return [x+(1-x)/2 for x in mcolors.to_rgb(color)]
@@ -169,6 +167,7 @@ class ColorBox:
             return default
         
     def get_dark(self,label,default="black"):
+        import matplotlib.colors as mcolors
         if label in self.labels:
             color = self.labels[label]
             return [x*0.75 for x in mcolors.to_rgb(color)]
@@ -176,6 +175,7 @@ class ColorBox:
             return default
 class PS_distribution:
     def __init__(self,interval,row,group_indices=None,betas={},width=0.05):
+        import matplotlib.pyplot as plt
         self.interval = interval
         self.ymax = 0
         self.width = width
@@ -217,6 +217,7 @@ class PS_distribution:
         self.ymax = max(self.ymax,max(counts))
 
     def plot_hists(self):
+        import matplotlib.patches as patches
         thick = (self.pw/self.ph) * (0.005*(1.1*self.ymax))
         for i,stack in enumerate(self.bars):
             left,right = self.bins[i],self.bins[i+1]
@@ -247,6 +248,7 @@ class PS_distribution:
         self.beta_labels.append(label)
 
     def beta_points(self,a,b,xdist=0.005):
+        from scipy import stats
         xs,ys = [],[]
         for x in np.arange(xdist/2,1,xdist):
             xs.append(x)
@@ -254,6 +256,7 @@ class PS_distribution:
         return xs,ys
         
     def fill_legend(self):
+        import matplotlib.patches as patches
         y = -1
         x = -3
         for label in self.hist_labels:
@@ -283,20 +286,96 @@ class PS_distribution:
         self.fig.savefig(f"{out_prefix}_{self.interval}.{time.time()}.png",dpi=dpi,bbox_inches="tight") 
         
 class PCA_plot:
-    def __init__(self,xs,ys,xy_pairs=[]):
+    def __init__(self,xs,ys,labels=None,axis_labels=("PC1","PC2")):
+        import matplotlib.pyplot as plt
         fw,fh = 6,4
-        pw,ph = 4,2
+        pw,ph = 3,3
         self.pw = pw
         self.ph = ph
         self.fig = plt.figure(figsize=(fw,fh))
         self.panel = self.fig.add_axes([0.5/fw,0.5/fh,pw/fw,ph/fh])
-        self.hist_labels = []
+        self.colors = ColorBox()
+        if labels is None:
+            labels = ["Samples" for x in xs]
+        self.labels = list(dict.fromkeys(labels))
+        for label in self.labels:
+            self.colors.add_label(label)
+        labels = np.array(labels)
+        for label in self.labels:
+            member = labels == label
+            self.panel.scatter(np.asarray(xs)[member],np.asarray(ys)[member],s=8,linewidth=0.2,
+                               facecolor=self.colors.get_color(label),edgecolor=self.colors.get_dark(label))
+        self.panel.set_xlabel(axis_labels[0])
+        self.panel.set_ylabel(axis_labels[1])
+        lw = 1 + (len(self.labels)//12)
+        self.legend = self.fig.add_axes([3.7/fw,0.5/fh,lw/fw,ph/fh])
+
+    def fill_legend(self):
+        y = -1
+        x = -3
+        for label in self.labels:
+            y = (y+1) % 12
+            if y == 0:
+                x += 3
+            self.legend.scatter([x+.25],[y+.5],s=20,linewidth=0.2,
+                                facecolor=self.colors.get_color(label),edgecolor=self.colors.get_dark(label))
+            self.legend.text(x+.5,y+.5,label,ha='left',va='center')
+        self.legend.axis("off")
+        self.legend.set_xlim(0,x+3)
+        self.legend.set_ylim(12,0)
 
     def save_fig(self,out_prefix,dpi=600):
         self.fill_legend()
         self.fig.savefig(f"{out_prefix}_pca.{time.time()}.png",dpi=dpi,bbox_inches="tight") 
 
-def get_args():
+class Distance_heatmap:
+    def __init__(self,distance,samples,order=None,labels=None,metric="pearson",max_tick_labels=60):
+        import matplotlib.pyplot as plt
+        import matplotlib.colors as mcolors
+        fw,fh = 7,6
+        pw,ph = 4.5,4.5
+        self.fig = plt.figure(figsize=(fw,fh))
+        self.panel = self.fig.add_axes([1/fw,0.5/fh,pw/fw,ph/fh])
+        self.strip = self.fig.add_axes([1/fw,(0.55+ph)/fh,pw/fw,0.15/fh])
+        self.colorbar = self.fig.add_axes([(1.2+pw)/fw,0.5/fh,0.15/fw,1.5/fh])
+        if order is None:
+            order = np.arange(len(samples))
+        self.colors = ColorBox()
+        if labels is None:
+            labels = ["Samples" for sample in samples]
+        self.labels = list(dict.fromkeys(labels))
+        for label in self.labels:
+            self.colors.add_label(label)
+        image = self.panel.imshow(distance[np.ix_(order,order)],cmap="viridis",aspect="auto",interpolation="nearest")
+        self.fig.colorbar(image,cax=self.colorbar,label=f"{metric} distance")
+        strip = np.array([[mcolors.to_rgb(self.colors.get_color(labels[k])) for k in order]])
+        self.strip.imshow(strip,aspect="auto",interpolation="nearest")
+        self.strip.set_xticks([])
+        self.strip.set_yticks([])
+        if len(samples) <= max_tick_labels:
+            names = [samples[k] for k in order]
+            self.panel.set_xticks(range(len(names)),names,rotation=90,fontsize=6)
+            self.panel.set_yticks(range(len(names)),names,fontsize=6)
+        else:
+            self.panel.set_xticks([])
+            self.panel.set_yticks([])
+        self.legend = self.fig.add_axes([(1.2+pw)/fw,2.3/fh,1/fw,2.7/fh])
+
+    def fill_legend(self):
+        import matplotlib.patches as patches
+        for y,label in enumerate(self.labels[:12]):
+            self.legend.add_patch(patches.Rectangle((.1,y+.2),.3,.6,linewidth=.1,edgecolor="black",
+                                                    facecolor=self.colors.get_color(label)))
+            self.legend.text(.5,y+.5,label,ha='left',va='center')
+        self.legend.axis("off")
+        self.legend.set_xlim(0,3)
+        self.legend.set_ylim(12,0)
+
+    def save_fig(self,out_prefix,dpi=600):
+        self.fill_legend()
+        self.fig.savefig(f"{out_prefix}_distance.{time.time()}.png",dpi=dpi,bbox_inches="tight")
+
+def get_args(argv=None):
     import argparse
     parser = argparse.ArgumentParser()
     parser.add_argument("-i","--intervals",default=None,
@@ -311,16 +390,73 @@ def get_args():
                         help="beta.tsv file with parameters for fit beta distributions.")
     parser.add_argument("-o","--out_prefix",default="splicedice",
                         help="Output path and filename before extensions [Default: 'splicedice']")
-    return parser.parse_args()
-
-
-
+    parser.add_argument("--max_text_cells",default=2500,type=int,
+                        help="Largest match table (rows x groups) that still gets per-cell count labels [Default: 2500]")
+    parser.add_argument("--pca",action="store_true",
+                        help="Sample PCA of the -p table, streamed in row blocks (.pca.tsv and a plot colored by -m groups).")
+    parser.add_argument("--components",default=10,type=int,
+                        help="Number of principal components to compute [Default: 10]")
+    parser.add_argument("--passes",default=4,type=int,
+                        help="Passes over the PS table for randomized subspace iteration (at least 2) [Default: 4]")
+    parser.add_argument("--seed",default=0,type=int,
+                        help="Random seed for the PCA starting subspace [Default: 0]")
+    parser.add_argument("--distance",default=None,
+                        help="Sample distance matrix from the distance mode (.dist.npz) to plot as a heatmap, in clustering "
+                             "order if it has one and with -m groups marked.")
+    return parser.parse_args(argv)
+
+
+
+
+def write_pca(out_prefix,samples,labels,scores,explained):
+    tab = '\t'
+    with open(f"{out_prefix}.pca.tsv",'w') as tsv:
+        tsv.write(f"sample\tgroup\t{tab.join(f'PC{k+1}' for k in range(scores.shape[1]))}\n")
+        for sample,label,row in zip(samples,labels,scores.tolist()):
+            tsv.write(f"{sample}\t{label}\t{tab.join(repr(x) for x in row)}\n")
+    with open(f"{out_prefix}.pca.variance.tsv",'w') as tsv:
+        tsv.write("component\tvariance_ratio\n")
+        for k,ratio in enumerate(explained.tolist()):
+            tsv.write(f"PC{k+1}\t{ratio!r}\n")
+
+def pca(args):
+    ps_table = Table(args.ps_table)
+    samples = ps_table.get_samples()
+    def read_blocks():
+        for i,ids,values in ps_table.get_blocks():
+            yield Table.load(values)
+    scores,explained = RandomizedPCA(args.components,args.passes,seed=args.seed).fit(read_blocks,len(samples))
+    labels = ["Samples" for sample in samples]
+    if args.manifest:
+        get_group = Manifest(args.manifest).get_group
+        labels = [get_group.get(sample,"unlabeled") for sample in samples]
+    write_pca(args.out_prefix,samples,labels,scores,explained)
+    if scores.shape[1] > 1:
+        pca_plot = PCA_plot(scores[:,0],scores[:,1],labels,
+                            axis_labels=(f"PC1 ({explained[0]:.1%})",f"PC2 ({explained[1]:.1%})"))
+        pca_plot.save_fig(args.out_prefix)
+
+def distance_heatmap(args):
+    with np.load(args.distance) as dist:
+        dist = dict(dist)
+    samples = dist["samples"].tolist()
+    labels = None
+    if args.manifest:
+        get_group = Manifest(args.manifest).get_group
+        labels = [get_group.get(sample,"unlabeled") for sample in samples]
+    heatmap = Distance_heatmap(dist["distance"],samples,dist.get("order"),labels,str(dist["metric"]))
+    heatmap.save_fig(args.out_prefix)
+
+def main(argv=None):
+    args = get_args(argv)
+    if args.distance:
+        distance_heatmap(args)
+    if args.ps_table and args.pca:
+        pca(args)
 
-def main():
-    args = get_args()
     if args.query and args.manifest:
         pmat = PvalMatrix(args.manifest,args.query)
-        pmat.plot_table(args.out_prefix)
+        pmat.plot_table(args.out_prefix,max_text_cells=args.max_text_cells)
 
     if args.ps_table and args.intervals and args.beta and args.manifest:
         manifest = Manifest(args.manifest)
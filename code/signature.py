@@ -1,10 +1,9 @@
 
 import numpy as np
-from scipy.stats import ranksums
-from statsmodels.stats.multitest import multipletests
+from functools import partial
 
-## 
-from tools import Beta,Multi,Table
+## scipy is imported inside the functions that use it to keep startup fast
+from tools import Beta,Bootstrap,Catalog,Checkpoint,Contrasts,ECDF,Multi,SharedArray,Sketch,SparseBlock,Table,TSV
 
 ## Suppress Warnings
 import warnings
@@ -13,18 +12,20 @@ warnings.simplefilter("ignore")
 ## Arguments and config parsing
 from config import get_config
 
-def get_args():
+def get_args(argv=None):
     import argparse
     parser = argparse.ArgumentParser()
-    parser.add_argument("mode",nargs="?",default="compare",choices=["compare","fit_beta","query"])
+    parser.add_argument("mode",nargs="?",default="compare",choices=["compare","fit_beta","query","store","compact","update"])
     parser.add_argument("-m","--manifest",default=None,
                         help="TSV file with list of samples (first column) and group labels (second column).")  
-    parser.add_argument("-p","--ps_table",default=None,
-                        help="Filename and path for .ps.tsv file, output from MESA.")
+    parser.add_argument("-p","--ps_table",default=None,nargs="+",
+                        help="Filename and path for .ps.tsv file, output from MESA. "
+                             "query accepts several tables and reads each of them once.")
     parser.add_argument("-s","--sig_file",default=None,
                         help="Filename and path for .sig.tsv file, previously output from splicedice.")
-    parser.add_argument("-b","--beta_file",default=None,
-                        help="Filename and path for .beta.tsv file, previously output from fit_beta.")
+    parser.add_argument("-b","--beta_file",default=None,nargs="+",
+                        help="Filename and path for .beta.tsv file, previously output from fit_beta. "
+                             "Several signatures can be queried in the same pass over the PS tables.")
     parser.add_argument("-a","--annotation",default=None,
                         help="GTF or splice_annotation.tsv file with gene annotation (optional for labeling/filtering)")
     parser.add_argument("-o","--output_prefix",
@@ -33,11 +34,77 @@ def get_args():
                         help = "Optional. For adjusting parameters of splicing analysis.")
     parser.add_argument("-ctrl","--control_name",default=None,
                         help="Sample group label that represents control for comparative analysis (default is first group in manifest).")
-    parser.add_argument("-n","--n_threads",default=4,type=int,
-                        help="Maximum number of processes to use at the same time.")
+    parser.add_argument("--contrasts",default="rest",choices=["rest","pairs","control","all"],
+                        help="Contrasts to test in compare mode. Each group is always tested against the rest of the samples; "
+                             "'pairs' adds all group pairs and 'control' each group against the control group "
+                             "(written to .contrasts.tsv).")
+    parser.add_argument("--test",default="ranksum",choices=["ranksum","permutation"],
+                        help="Test for group vs rest p-values in compare mode. 'permutation' also gives p-values "
+                             "for groups with 2 or fewer values, and stops early for intervals that are clearly not significant.")
+    parser.add_argument("--permutations",default=10000,type=int,
+                        help="Maximum number of label permutations per interval for --test permutation.")
+    parser.add_argument("--seed",default=0,type=int,
+                        help="Random seed for permutation tests and bootstrap resampling.")
+    parser.add_argument("--bootstrap_iters","--bootstrap-iters",default=0,type=int,
+                        help="Number of bootstrap resamples for confidence intervals of median deltas (compare) "
+                             "and beta parameters (fit_beta). Default 0 skips the bootstrap.")
+    parser.add_argument("--n_tested",default=None,type=int,
+                        help="fit_beta -s: override the number of intervals compare tested, the FDR denominator. "
+                             "Default: the count compare saved in {sig prefix}.sig.json, else the number of intervals in the sig file.")
+    parser.add_argument("--fused",action="store_true",
+                        help="fit_beta without -s: fit beta distributions during the compare pass for every interval "
+                             "passing the raw thresholds and keep the fits that pass FDR, so the PS table is read in a single pass.")
+    parser.add_argument("--cdf_grid",default=0,type=int,
+                        help="Grid size for beta cdf lookup tables written by fit_beta to .cdf.npz "
+                             "(4 bytes per grid point, interval and group; default 0 writes no table).")
+    parser.add_argument("--cdf_table",default=None,nargs="+",
+                        help="Optional .cdf.npz file from fit_beta --cdf_grid (one per beta file); query interpolates "
+                             "in the tables instead of evaluating beta cdfs.")
+    parser.add_argument("--ecdf",action="store_true",
+                        help="fit_beta also writes each group's sorted reference PS values to .ecdf.npz, "
+                             "for distribution-free queries that do not depend on the beta fits.")
+    parser.add_argument("--sufficient",action="store_true",
+                        help="fit_beta also writes per-group sufficient statistics (n, sum log x, sum log 1-x and a median "
+                             "sketch with --median_error resolution) to .suff.npz, so that update can add samples later.")
+    parser.add_argument("--suff_table",default=None,
+                        help="update: .suff.npz file of the beta file, from fit_beta --sufficient or an earlier update.")
+    parser.add_argument("--ecdf_table",default=None,nargs="+",
+                        help="Optional .ecdf.npz file from fit_beta --ecdf (one per beta file); query takes tail "
+                             "probabilities from the empirical cdfs of the reference values.")
+    parser.add_argument("--combined_pvals",action="store_true",
+                        help="With several beta files, write one .pvals.tsv with the signature name before each query "
+                             "instead of one {output_prefix}.{signature}.pvals.tsv per signature.")
+    Multi.add_arguments(parser)
+    parser.add_argument("--dtype",default=None,choices=["float64","float32","float16","uint16"],
+                        help="Storage type for PS values and query probabilities in worker buffers and binary stores "
+                             "(statistics are always accumulated in float64). uint16 is a quantized [0,1] encoding with a NaN sentinel. "
+                             "Default: the type of a binary store, float64 for a .ps.tsv, and float32 for the store written in store mode.")
+    parser.add_argument("--sparse",action="store_true",
+                        help="Keep only observed (non-NaN) PS values in worker blocks, for tables that are mostly NaN. "
+                             "In store mode, writes a sparse .ps.csr.npz store, which is always read this way.")
+    parser.add_argument("--approx_median",action="store_true",
+                        help="In compare, take median_ and delta_ columns and the delta threshold filter from "
+                             "histogram sketches built in one pass over each block, and rank only rows that pass the filter.")
+    parser.add_argument("--median_error",default=0.005,type=float,
+                        help="Largest error in PS units of approximate medians (sketch bin width).")
+    parser.add_argument("--column_chunk",default=4096,type=int,
+                        help="Number of samples added to the median sketches at a time.")
+    parser.add_argument("--precision",default=None,type=int,
+                        help="Significant digits for numbers in output tables (default: shortest exact representation).")
+    parser.add_argument("--resume",action="store_true",
+                        help="Continue an interrupted run with the same inputs and options from its checkpoint files "
+                             "({output_prefix}.{stage}.partial and .checkpoint.json).")
+    parser.add_argument("--checkpoint_seconds",default=300,type=float,
+                        help="Seconds between checkpoint flushes of finished blocks (0 disables checkpointing).")
+    parser.add_argument("--correlation_cutoffs",default=[0.5,0.6,0.7,0.8,0.9,0.95],type=float,nargs="+",
+                        help="compact: absolute correlations across the reference samples above which overlapping intervals "
+                             "count as redundant; the lowest cutoff within --max_accuracy_loss is used.")
+    parser.add_argument("--max_accuracy_loss",default=0.01,type=float,
+                        help="compact: largest drop in the fraction of reference samples (-m) whose queries against their "
+                             "own group are called correctly (p < significance threshold) [Default: 0.01]")
     parser.add_argument("-x","--extra_args",default="",
                         help="Extra config arguments in this format: attribute1=x,attribute2=y")
-    return parser.parse_args()
+    return parser.parse_args(argv)
      
 def check_args_and_config(args,config):
     if args.mode == "compare":
@@ -47,71 +114,183 @@ def check_args_and_config(args,config):
         return True
     elif args.mode == "compare":
         return True
+    if args.mode == "compact" and (not args.ps_table or not args.manifest or not args.beta_file or len(args.beta_file) > 1):
+        exit("compact needs one beta file (-b), the reference PS table (-p) and its manifest (-m)")
+    if args.mode == "update" and (not args.ps_table or not args.manifest or not args.suff_table
+                                  or not args.beta_file or len(args.beta_file) > 1):
+        exit("update needs one beta file (-b), its --suff_table, and the new samples' PS table (-p) and manifest (-m)")
+    if args.mode != "query" and args.ps_table and len(args.ps_table) > 1:
+        exit(f"{args.mode} takes a single PS table")
+    if args.mode == "query" and args.cdf_table and len(args.cdf_table) != len(args.beta_file):
+        exit("query needs one --cdf_table per beta file")
+    if args.mode == "query" and args.ecdf_table and (args.cdf_table or len(args.ecdf_table) != len(args.beta_file)):
+        exit("query needs one --ecdf_table per beta file, and no --cdf_table")
     return True
 
+def signature_names(beta_files):
+    import os
+    names = []
+    for beta_file in beta_files:
+        name = os.path.basename(beta_file)
+        name = name[:-len(".beta.tsv")] if name.endswith(".beta.tsv") else name
+        names.append(name if name not in names else f"{name}{len(names)+1}")
+    return names
+
 #### Main ####
-def main():
+def main(argv=None):
     # Arguments and configuration specifications
-    args = get_args()
+    args = get_args(argv)
     config = get_config(args.config_file,args.extra_args)
     check_args_and_config(args=args,config=config)
 
 
 
-    manifest = Manifest(filename=args.manifest,n_threads=args.n_threads,
+    # Intervals are passed around as catalog IDs and only formatted when writing
+    catalog = Catalog()
+    manifest = Manifest(filename=args.manifest,control_name=args.control_name,n_threads=args.n_threads,backend=args.backend,
                         threshold=config["significance_threshold"],
-                        delta_threshold=config['delta_threshold'])
+                        delta_threshold=config['delta_threshold'],precision=args.precision,catalog=catalog)
 
-    ps_table = Table(filename=args.ps_table,store=None)
+    ps_tables = [Table(filename=filename,store=None,dtype=args.dtype,sparse=args.sparse)
+                 for filename in args.ps_table or [None]]
+    ps_table = ps_tables[0]
+    if args.mode != "store":
+        for table in ps_tables:
+            if table.filename:
+                table.register(catalog)
+    bootstrap = Bootstrap(args.bootstrap_iters,seed=args.seed) if args.bootstrap_iters > 0 else None
+    sketch = (args.median_error,args.column_chunk) if args.approx_median else None
+    if args.mode != "store" and args.checkpoint_seconds > 0:
+        settings = {k:v for k,v in vars(args).items() if k not in ("n_threads","backend","resume","checkpoint_seconds")}
+        settings.update(config=config,block_size=ps_table.block_size)
+        filenames = [args.manifest,args.sig_file] + (args.ps_table or []) + (args.beta_file or []) + (args.cdf_table or []) + (args.ecdf_table or []) + [args.suff_table]
+        fingerprint = Checkpoint.get_fingerprint(filenames,settings)
+        manifest.set_checkpoints(args.output_prefix,fingerprint,args.resume,args.checkpoint_seconds)
 
     if args.mode == "compare":
         print("Testing for differential splicing...")
-        groups,med_stats,compare_stats = manifest.compare_multi(ps_table,
+        groups,med_stats,compare_stats,contrast_stats,_ = manifest.compare_multi(ps_table,
                                                                 threshold=config['significance_threshold'],
-                                                                delta_threshold=config['delta_threshold'])
+                                                                delta_threshold=config['delta_threshold'],
+                                                                contrasts=args.contrasts,test=args.test,
+                                                                n_permutations=args.permutations,seed=args.seed,
+                                                                bootstrap=bootstrap,sketch=sketch)
         print("Writing...")
         manifest.write_sig(args.output_prefix,groups,med_stats,compare_stats)
+        if args.contrasts != "rest":
+            manifest.write_contrasts(args.output_prefix,*contrast_stats)
 
     elif args.mode == "fit_beta":
         if args.sig_file:
             print("Reading...")
             groups,compare_stats = manifest.read_sig(args.sig_file)
+            if args.n_tested:
+                manifest.n_tested = args.n_tested
             med_stats = None
         else:
             print("Testing for differential splicing...")
-            groups,med_stats,compare_stats = manifest.compare_multi(ps_table,
+            groups,med_stats,compare_stats,contrast_stats,candidate_stats = manifest.compare_multi(ps_table,
                                                                 threshold=config['significance_threshold'],
-                                                                delta_threshold=config['delta_threshold'])
+                                                                delta_threshold=config['delta_threshold'],
+                                                                test=args.test,n_permutations=args.permutations,
+                                                                seed=args.seed,bootstrap=bootstrap,sketch=sketch,
+                                                                fit=args.fused,ecdf=args.ecdf or args.sufficient)
 
-        print("Fitting beta distributions...")
-        beta_stats = manifest.fit_betas(ps_table,compare_stats)
+        if args.fused and not args.sig_file:
+            beta_stats,reference_stats = manifest.select_betas(compare_stats,candidate_stats)
+        else:
+            print("Fitting beta distributions...")
+            beta_stats,reference_stats = manifest.fit_betas(ps_table,compare_stats,bootstrap=bootstrap,
+                                                            ecdf=args.ecdf or args.sufficient)
         print("Writing files...")
         if med_stats:
             manifest.write_sig(args.output_prefix,groups=groups,med_stats=med_stats,compare_stats=compare_stats)
 
         groups = manifest.get_group_indices(ps_table.get_samples())
         manifest.write_beta(args.output_prefix,groups=groups,beta_stats=beta_stats)
+        if args.cdf_grid:
+            print("Writing cdf tables...")
+            error = manifest.write_cdf(args.output_prefix,groups,beta_stats,args.cdf_grid)
+            print(f"Max cdf interpolation error: {error:.3g}")
+        if args.ecdf:
+            print("Writing reference values...")
+            manifest.write_ecdf(args.output_prefix,groups,reference_stats)
+        if args.sufficient:
+            print("Writing sufficient statistics...")
+            manifest.write_sufficient(args.output_prefix,groups,*manifest.reference_sufficient(reference_stats,len(groups),
+                                                                                                 Sketch.n_bins(args.median_error)))
+
+    elif args.mode == "store":
+        print("Writing binary store...")
+        dtype = args.dtype or "float32"
+        filename = ps_table.write_store(args.output_prefix,dtype=dtype)
+        print(f"Wrote {filename} ({dtype})")
 
     elif args.mode == "query":
         print("Reading...")
-        groups,beta_stats = manifest.read_beta(args.beta_file)
+        signatures = [manifest.read_beta(beta_file) for beta_file in args.beta_file]
+        cdfs = None
+        if args.cdf_table:
+            cdfs = [manifest.read_cdf(cdf_file,groups,beta_stats)
+                    for cdf_file,(groups,beta_stats) in zip(args.cdf_table,signatures)]
+            grid_sizes = ",".join(str(cdf['table'].shape[-1]) for cdf in cdfs)
+            error = max(cdf['error'] for cdf in cdfs)
+            print(f"Using cdf tables with grid size {grid_sizes}, max interpolation error {error:.3g}")
+        ecdfs = None
+        if args.ecdf_table:
+            ecdfs = [manifest.read_ecdf(ecdf_file,groups,beta_stats)
+                     for ecdf_file,(groups,beta_stats) in zip(args.ecdf_table,signatures)]
         print("Querying...")
-        samples,queries,pvals = manifest.query(ps_table,groups,beta_stats)
+        samples,signature_pvals = manifest.query(ps_tables,signatures,cdfs=cdfs,ecdfs=ecdfs)
         print("Writing...")
+        names = signature_names(args.beta_file)
+        if len(names) == 1:
+            manifest.write_pvals(args.output_prefix,samples,*signature_pvals[0])
+        elif args.combined_pvals:
+            queries = [f"{name}:{query}" for name,(queries,pvals) in zip(names,signature_pvals) for query in queries]
+            pvals = [row for queries,pvals in signature_pvals for row in pvals]
+            manifest.write_pvals(args.output_prefix,samples,queries,pvals)
+        else:
+            for name,(queries,pvals) in zip(names,signature_pvals):
+                manifest.write_pvals(f"{args.output_prefix}.{name}",samples,queries,pvals)
 
-        manifest.write_pvals(args.output_prefix,samples,queries,pvals)
+    elif args.mode == "compact":
+        print("Reading...")
+        groups,beta_stats = manifest.read_beta(args.beta_file[0],extended=True)
+        print("Compacting signature...")
+        compact_stats = manifest.compact(ps_table,groups,beta_stats,args.correlation_cutoffs,args.max_accuracy_loss)
+        print("Writing...")
+        manifest.write_beta(args.output_prefix,groups=groups,beta_stats=compact_stats)
+
+    elif args.mode == "update":
+        print("Reading...")
+        groups,beta_stats = manifest.read_beta(args.beta_file[0])
+        sufficient = manifest.read_sufficient(args.suff_table,groups,beta_stats)
+        print("Adding samples...")
+        beta_stats,sufficient = manifest.update(ps_table,groups,beta_stats,sufficient)
+        print("Writing...")
+        manifest.write_beta(args.output_prefix,groups=groups,beta_stats=beta_stats)
+        manifest.write_sufficient(args.output_prefix,groups,list(beta_stats),sufficient)
+
+    manifest.remove_checkpoints()
 
 #### Manifest Class ####    
 class Manifest:
-    def __init__(self,filename=None,control_name=None,n_threads=4,threshold=0.05,delta_threshold=0):
+    def __init__(self,filename=None,control_name=None,n_threads=4,threshold=0.05,delta_threshold=0,precision=None,catalog=None,backend="process"):
         self.samples = []
         self.groups = {}
         self.get_group = {}
         self.beta = Beta()
         self.controls = {}
         self.n_threads = n_threads
+        self.backend = backend
         self.threshold = threshold
+        self.n_tested = None
         self.delta_threshold = delta_threshold
+        self.control_name = control_name
+        self.precision = precision
+        self.checkpoints = None
+        self.catalog = catalog if catalog is not None else Catalog()
         if filename:
             with open(filename) as manifest_file:
                 for line in manifest_file:
@@ -124,6 +303,7 @@ class Manifest:
                             control_name = group_name
                         self.groups[group_name] = []
                     self.groups[group_name].append(sample_name)
+            self.control_name = control_name
             for group_name in self.groups.keys():
                 self.controls[group_name] = control_name
             self.index = {sample:i for i,sample in enumerate(self.samples)}
@@ -139,7 +319,8 @@ class Manifest:
         if anti:
             anti_indices = {}
             for name,group in group_indices.items():
-                anti_indices[name]  = [i for i,s in enumerate(samples) if s not in group]
+                group = set(group)
+                anti_indices[name]  = [i for i in range(len(samples)) if i not in group]
             return group_indices, anti_indices
         else:
             return group_indices
@@ -147,156 +328,229 @@ class Manifest:
 
     
 
-    def read_beta(self,beta_file):
+    def read_beta(self,beta_file,extended=False):
+        # extended: also the bootstrap interval columns, if the file has them
+        stats = ["median","alpha","beta"]
+        if extended and "alphalow" in TSV.stat_columns(TSV.read_header(beta_file)[1:])[1]:
+            stats.extend(["alphalow","alphahigh","betalow","betahigh"])
         beta_stats = {}
-        with open(beta_file) as tsv:
-            header = tsv.readline().rstrip().split("\t")[1:]
-            groups = {}
-            for i,column in enumerate(header):
-                info_type,group_name = column.split("_",1)
-                if group_name not in groups:
-                    groups[group_name] = {}
-                groups[group_name][info_type] = i
-            for line in tsv:
-                row = line.rstrip('\n').split('\t')
-                interval = row[0]
-                beta_stats[interval] = []
-                row = row[1:]
-                for i,x in enumerate(row):
-                    try:
-                        row[i] = float(x)
-                    except ValueError:
-                        row[i] = float('nan')
-                for group_name in groups:
-                    median = row[groups[group_name]["median"]]
-                    alpha = row[groups[group_name]["alpha"]]
-                    beta = row[groups[group_name]["beta"]]
-                    beta_stats[interval].append([median,alpha,beta])
-
-        groups = list(groups.keys())
+        # Groups come from the header, so that a signature without intervals still has them
+        groups = TSV.stat_columns(TSV.read_header(beta_file)[1:])[0]
+        for groups,intervals,values in TSV.read_stats(beta_file,stats):
+            beta_stats.update(zip(self.catalog.add(intervals).tolist(),values.tolist()))
         return groups,beta_stats
     
     def read_sig(self,sig_file):
         compare_stats = {}
-        with open(sig_file) as tsv:
-            columns = tsv.readline().rstrip('\n').split("\t")[1:]
-            groups = {}
-            for i,column in enumerate(columns):
-                info_type,group_name = column.split("_",1)
-                if group_name not in groups:
-                    groups[group_name] = {}
-                groups[group_name][info_type] = i
-            for line in tsv:
-                row = line.rstrip('\n').split('\t')
-                interval = row[0]
-                compare_stats[interval] = []
-                row = row[1:]
-                for i,x in enumerate(row):
-                    try:
-                        row[i] = float(x)
-                    except ValueError:
-                        row[i] = float('nan')
-                for group_name in groups:
-                    delta = row[groups[group_name]["delta"]]
-                    pval = row[groups[group_name]["pval"]]
-                    compare_stats[interval].append([delta,pval])
-        groups = list(groups.keys())
+        groups = TSV.stat_columns(TSV.read_header(sig_file)[1:])[0]
+        for groups,intervals,values in TSV.read_stats(sig_file,["delta","pval"]):
+            compare_stats.update(zip(self.catalog.add(intervals).tolist(),values.tolist()))
+        import json
+        import os
+        sig_info = f"{sig_file[:-len('.tsv')]}.json" if sig_file.endswith(".sig.tsv") else None
+        if sig_info and os.path.exists(sig_info):
+            with open(sig_info) as sig_info:
+                self.n_tested = json.load(sig_info)["n_tested"]
+        else:
+            print(f"No tested interval count saved with {sig_file}; the FDR step counts only its intervals")
         return groups,compare_stats
           
     def write_sig(self,output_prefix,groups=None,med_stats=None,compare_stats=None):
-        header = ["splice_interval"]        
-        for name in groups:
-            header.extend([f"median_{name}",f"mean_{name}",f"delta_{name}",f"pval_{name}"])
-        with open(f"{output_prefix}.sig.tsv",'w') as tsv:
-            tab = '\t'
-            tsv.write(f"{tab.join(header)}\n")
-            for interval in compare_stats.keys():
-                row = [interval]
-                for m,c in zip(med_stats[interval],compare_stats[interval]):
-                    row.append(f'{m[0]}\t{m[1]}\t{c[0]}\t{c[1]}')
-                tsv.write(f"{tab.join(row)}\n")
+        stats = ["median","mean","delta","pval"]
+        if any(len(c[0]) > 2 for c in compare_stats.values()):
+            stats.extend(["deltalow","deltahigh"])
+        header = ["splice_interval"] + TSV.stat_header(groups,stats)
+        def get_values(intervals):
+            return np.concatenate([np.array([med_stats[interval] for interval in intervals],dtype=float),
+                                   np.array([compare_stats[interval] for interval in intervals],dtype=float)],axis=2)
+        TSV.write_chunks(f"{output_prefix}.sig.tsv",header,TSV.chunked(compare_stats.keys(),get_values,format_names=self.catalog.format),self.precision)
+        if self.n_tested is not None:
+            # Intervals dropped before the sig file still count in the FDR denominator of fit_beta -s
+            import json
+            with open(f"{output_prefix}.sig.json",'w') as sig_info:
+                json.dump({"n_tested":self.n_tested},sig_info)
 
     def write_beta(self,output_prefix,groups=None,beta_stats=None,):
-        header = ["splice_interval"]
-        intervals = beta_stats.keys()
-        for name in groups:
-            header.extend([f"median_{name}",f"alpha_{name}",f"beta_{name}"])
-        with open(f"{output_prefix}.beta.tsv",'w') as tsv:
-            tab = '\t'
-            tsv.write(f"{tab.join(header)}\n")
-            for interval in intervals:
-                mabs = []
-                for mab in beta_stats[interval]:
-                    mabs.extend(str(x) for x in mab)
-                tsv.write(f"{interval}\t{tab.join(mabs)}\n")
+        stats = ["median","alpha","beta"]
+        if any(len(mabs[0]) > 3 for mabs in beta_stats.values()):
+            stats.extend(["alphalow","alphahigh","betalow","betahigh"])
+        header = ["splice_interval"] + TSV.stat_header(groups,stats)
+        def get_values(intervals):
+            return np.array([beta_stats[interval] for interval in intervals],dtype=float)
+        TSV.write_chunks(f"{output_prefix}.beta.tsv",header,TSV.chunked(beta_stats.keys(),get_values,format_names=self.catalog.format),self.precision)
+
+    def write_contrasts(self,output_prefix,names=None,contrast_stats=None):
+        header = ["splice_interval"] + TSV.stat_header(names,["delta","pval"])
+        def get_values(intervals):
+            return np.array([contrast_stats[interval] for interval in intervals],dtype=float)
+        TSV.write_chunks(f"{output_prefix}.contrasts.tsv",header,TSV.chunked(contrast_stats.keys(),get_values,format_names=self.catalog.format),self.precision)
+
+    def write_cdf(self,output_prefix,groups,beta_stats,grid_size):
+        intervals = list(beta_stats.keys())
+        mabs = np.array([[mab[:3] for mab in beta_stats[interval]] for interval in intervals],dtype=float).reshape(len(intervals),len(groups),3)
+        table,errors = self.beta.cdf_table(mabs[:,:,1],mabs[:,:,2],grid_size)
+        np.savez(f"{output_prefix}.cdf.npz",intervals=np.array(self.catalog.format(intervals)),groups=np.array(list(groups)),
+                 table=table,errors=errors)
+        return float(np.nanmax(errors,initial=0))
+
+    def table_index(self,data,filename,groups,beta_stats,contents):
+        # Row of each interval in a .npz table saved with a signature, checked against the beta file
+        if list(data["groups"]) != list(groups):
+            raise ValueError(f"{filename} groups do not match the beta file")
+        index = {interval:r for r,interval in enumerate(self.catalog.add(data["intervals"].tolist()).tolist())}
+        missing = [interval for interval in beta_stats if interval not in index]
+        if missing:
+            raise ValueError(f"{filename} has no {contents} for {len(missing)} beta file intervals, "
+                             f"e.g. {self.catalog.format(missing[:1])[0]}")
+        return index
+
+    def read_cdf(self,cdf_file,groups,beta_stats):
+        with np.load(cdf_file) as data:
+            index = self.table_index(data,cdf_file,groups,beta_stats,"table")
+            return {"index":index,"table":data["table"],"error":float(np.nanmax(data["errors"],initial=0))}
+
+    def write_ecdf(self,output_prefix,groups,reference_stats):
+        # Sorted float32 reference values of each (interval,group), concatenated with their offsets
+        intervals = list(reference_stats.keys())
+        references = [values for interval in intervals for values in reference_stats[interval]]
+        offsets = np.cumsum([0] + [len(values) for values in references])
+        np.savez(f"{output_prefix}.ecdf.npz",intervals=np.array(self.catalog.format(intervals)),groups=np.array(list(groups)),
+                 values=np.concatenate([np.zeros(0,dtype=np.float32)] + references),offsets=offsets)
+
+    def read_ecdf(self,ecdf_file,groups,beta_stats):
+        with np.load(ecdf_file) as data:
+            index = self.table_index(data,ecdf_file,groups,beta_stats,"reference values")
+            return {"index":index,"values":data["values"],"offsets":data["offsets"]}
+
+    def write_sufficient(self,output_prefix,groups,intervals,sufficient):
+        n,sum_log,sum_log1m,sketch = sufficient
+        np.savez(f"{output_prefix}.suff.npz",intervals=np.array(self.catalog.format(intervals)),groups=np.array(list(groups)),
+                 n=n,sum_log=sum_log,sum_log1m=sum_log1m,sketch=sketch)
+
+    def read_sufficient(self,suff_file,groups,beta_stats):
+        # Statistics in the row order of beta_stats
+        with np.load(suff_file) as data:
+            index = self.table_index(data,suff_file,groups,beta_stats,"statistics")
+            rows = [index[interval] for interval in beta_stats]
+            return tuple(data[key][rows] for key in ("n","sum_log","sum_log1m","sketch"))
 
     def write_pvals(self,output_prefix,samples,queries,pvals):
-        with open(f"{output_prefix}.pvals.tsv",'w') as tsv:
-            tab = "\t"
-            tsv.write(f"query\t{tab.join(samples)}\n")
-            for i in range(len(queries)):
-                tsv.write(f"{queries[i]}\t{tab.join(str(x) for x in pvals[i])}\n")
+        pvals = np.array(pvals,dtype=float).reshape(len(queries),len(samples))
+        TSV.write_chunks(f"{output_prefix}.pvals.tsv",["query"]+list(samples),[(queries,pvals)],self.precision)
     
-    def compare_multi(self,ps_table,threshold=0.05,delta_threshold=0):
-        import multiprocessing
+    def set_checkpoints(self,output_prefix,fingerprint,resume=False,interval=300):
+        self.checkpoints = {"settings":(output_prefix,fingerprint,resume,interval)}
+
+    def remove_checkpoints(self):
+        if self.checkpoints:
+            for stage,checkpoint in self.checkpoints.items():
+                if stage != "settings":
+                    checkpoint.remove()
+
+    def run_blocks(self,stage,read_function,read_info,f,info,buffer_ratio=10):
+        # Block results in table order, skipping blocks already finished in a checkpoint
+        if not self.checkpoints:
+            results = Multi.run(read_function,read_info,f,info,self.n_threads,buffer_ratio,backend=self.backend)
+            return sorted(results,key=lambda x:x[0])
+        output_prefix,fingerprint,resume,interval = self.checkpoints["settings"]
+        checkpoint = Checkpoint(output_prefix,stage,fingerprint,resume,interval)
+        self.checkpoints[stage] = checkpoint
+        if not checkpoint.complete:
+            for result in Multi.run(read_function,read_info,f,info,self.n_threads,buffer_ratio,skip=checkpoint.done(),backend=self.backend):
+                checkpoint.add(result[0],result)
+        else:
+            # All blocks are finished, but the reader still has to stream past them to intern the table's
+            # interval IDs in the order of the interrupted run
+            for item in Multi.read_items(read_function,read_info,checkpoint.done()):
+                pass
+        return checkpoint.close()
+
+    def compare_multi(self,ps_table,threshold=0.05,delta_threshold=0,contrasts="rest",
+                      test="ranksum",n_permutations=10000,seed=0,bootstrap=None,sketch=None,fit=False,ecdf=False):
         med_stats = {}
         compare_stats = {}
-        indices = self.get_group_indices(ps_table.get_samples(),anti=True)
-        sizes = [f"{k} ({len(v)})" for k,v in indices[0].items()]
+        contrast_stats = {}
+        candidate_stats = {}
+        samples = ps_table.get_samples()
+        indices = self.get_group_indices(samples)
+        sizes = [f"{k} ({len(v)})" for k,v in indices.items()]
         print(f"Groups: {', '.join(sizes)}")
-        n = self.n_threads
-        buffer_ratio = 10
-        with multiprocessing.Manager() as manager:
-            q1 = manager.Queue(maxsize = n * buffer_ratio)
-            q2 = manager.Queue()
-            #o = manager.dict()
-            read_process = multiprocessing.Process(target=Multi.mp_reader,
-                                                   args=(ps_table.get_rows,None,q1,n))
-            read_process.start()
-            pool = [multiprocessing.Process(target=Multi.mp_do_rows,args=(q1,self.row_compare,indices,q2)) for n in range(n-2)] 
-            for p in pool:
-                p.start()
-            done_count = 0
-            while True:
-                item = q2.get()
-                if item == "DONE":
-                    done_count += 1
-                    if done_count == n-2:
-                        break
-                    continue
-                interval,m_stats,c_stats = item
-                for s in c_stats:
-                    if s[0] and abs(s[0])>delta_threshold and s[1] and s[1] < threshold:
-                        compare_stats[interval] = c_stats
-                        med_stats[interval] = m_stats
-                        break
-            read_process.join()
-            for p in pool:
-                p.join()
-        return list(indices[0].keys()),med_stats,compare_stats
-    
-    def row_compare(self,item,indices):
-        interval,row = item
-        group_indices,anti_indices = indices
-        c_stats = []
-        m_stats = []
-        nan_check = [np.isnan(x) for x in row]
-        for group,indices in group_indices.items():
-            values = [row[i] for i in indices if not nan_check[i]]
-            anti_values = [row[i] for i in anti_indices[group] if not nan_check[i]]
-            median = np.median(values)
-            delta = median-np.median(anti_values)
-            if len(values)>2 and len(anti_values)>2:
-                D,pval = ranksums(values,anti_values)
-            else:
-                pval = None
-            c_stats.append([median-np.median(anti_values),pval])
-            m_stats.append([median,np.mean(values)])
-        return interval,m_stats,c_stats
+        engine = Contrasts(indices,len(samples),
+                           control=self.control_name if contrasts in ("control","all") else None,
+                           pairs=contrasts in ("pairs","all"))
+        options = {"test":test}
+        if test == "permutation":
+            options.update(threshold=threshold,n_permutations=n_permutations,seed=seed)
+        results = self.run_blocks("compare",ps_table.get_blocks,None,self.block_compare,
+                                  (engine,threshold,delta_threshold,options,bootstrap,sketch,(indices,ecdf) if fit else None))
+        self.n_tested = sum(n_rows for i,n_rows,n_ranked,rows in results)
+        ranked = sum(n_ranked for i,n_rows,n_ranked,rows in results)
+        print(f"Delta prefilter: {ranked} of {self.n_tested} intervals ranked ({ranked / max(1,self.n_tested):.1%})")
+        for i,n_rows,n_ranked,rows in results:
+            for interval,m_stats,c_stats,x_stats,fit_row in rows:
+                if c_stats:
+                    compare_stats[interval] = c_stats
+                    med_stats[interval] = m_stats
+                if x_stats:
+                    contrast_stats[interval] = x_stats
+                if fit_row:
+                    candidate_stats[interval] = fit_row
+        return list(indices.keys()),med_stats,compare_stats,(engine.pair_names,contrast_stats),candidate_stats
+
+    def block_compare(self,item,info):
+        i,intervals,values = item
+        values = Table.decode(Table.load(values))
+        engine,threshold,delta_threshold,options,bootstrap,sketch,fit = info
+        n_rows = len(intervals)
+        if sketch or delta_threshold > 0:
+            intervals,values,approx = self.delta_prefilter(intervals,values,engine,delta_threshold,sketch)
+        medians,means,deltas,pvals,pair_deltas,pair_pvals = engine.compare(values,**options)
+        if sketch:
+            medians,deltas,pair_deltas = approx
+        keep = ((np.abs(deltas) > delta_threshold) & (pvals < threshold)).any(axis=1)
+        keep_pairs = ((np.abs(pair_deltas) > delta_threshold) & (pair_pvals < threshold)).any(axis=1)
+        c_columns = [deltas,pvals]
+        if bootstrap:
+            kept = (values.dense() if isinstance(values,SparseBlock) else values)[keep]
+            lows,highs = np.full(deltas.shape,np.nan),np.full(deltas.shape,np.nan)
+            for g in range(engine.n_groups):
+                lows[keep,g],highs[keep,g] = bootstrap.median_delta_ci(kept[:,engine.labels == g],
+                                                                       kept[:,engine.labels != g],stream=g)
+            c_columns.extend([lows,highs])
+        fits = {}
+        if fit:
+            fit_indices,ecdf = fit
+            kept_rows = np.flatnonzero(keep)
+            kept = values.take(kept_rows) if isinstance(values,SparseBlock) else values[kept_rows]
+            references = self.reference_rows(kept,fit_indices) if ecdf else [None] * len(kept_rows)
+            fits = dict(zip(kept_rows.tolist(),zip(self.fit_rows(kept,fit_indices,bootstrap),references)))
+        rows = []
+        for r in np.flatnonzero(keep | keep_pairs):
+            m_stats = np.stack([medians[r],means[r]],axis=1).tolist() if keep[r] else None
+            c_stats = np.stack([c[r] for c in c_columns],axis=1).tolist() if keep[r] else None
+            x_stats = np.stack([pair_deltas[r],pair_pvals[r]],axis=1).tolist() if keep_pairs[r] else None
+            rows.append((int(intervals[r]),m_stats,c_stats,x_stats,fits.get(r)))
+        return i,n_rows,len(intervals),rows
     
+    def delta_prefilter(self,intervals,values,engine,delta_threshold,sketch=None):
+        # Cascade: medians and deltas of the whole block first, exact or from one pass of sketches,
+        # so that only rows where a delta passes the threshold are ranked
+        if sketch:
+            error,column_chunk = sketch
+            medians,rest_medians = Sketch(len(intervals),engine.n_groups+1,error).add(values,engine.labels,column_chunk).medians(engine.n_groups)
+        else:
+            medians,rest_medians = engine.medians(values)
+        deltas = medians - rest_medians
+        pair_deltas = np.stack([medians[:,a] - medians[:,b] for a,b in engine.pairs],axis=1) if engine.pairs else np.empty((len(intervals),0))
+        with np.errstate(invalid="ignore"):
+            rows = np.flatnonzero((np.abs(deltas) > delta_threshold).any(axis=1) | (np.abs(pair_deltas) > delta_threshold).any(axis=1))
+        values = values.take(rows) if isinstance(values,SparseBlock) else values[rows]
+        return intervals[rows],values,(medians[rows],deltas[rows],pair_deltas[rows])
+
     def significant_intervals(self,compare_stats):
+        # Benjamini-Hochberg over every interval compare tested, including those the delta prefilter dropped
         significant = set()
-        n = len(compare_stats)
+        n = self.n_tested or len(compare_stats)
         for data in compare_stats.values():
             m = len(data)
             break
@@ -316,94 +570,246 @@ class Manifest:
                     significant.add(pvals[i][2])
         return significant
     
-    def row_fit_beta(self,row,group_indices):
-        interval,row = row
-        nan_check = [np.isnan(x) for x in row]
-        mab_row = []
+    def block_fit_beta(self,item,info):
+        i,intervals,values = item
+        values = Table.decode(Table.load(values))
+        group_indices,bootstrap,ecdf = info
+        references = self.reference_rows(values,group_indices) if ecdf else [None] * len(intervals)
+        return i,list(zip(intervals.tolist(),self.fit_rows(values,group_indices,bootstrap),references))
+
+    def reference_rows(self,values,group_indices):
+        # Sorted observed values of each group, the reference distributions of an ECDF signature
+        references = [[] for r in range(len(values))]
         for index in group_indices.values():
-            mab_row.append(self.beta.fit_beta([row[i] for i in index if not nan_check[i]]))
-        return interval,mab_row
+            if isinstance(values,SparseBlock):
+                group_values = values.select(index)
+                rows = np.split(group_values.data,group_values.indptr[1:-1])
+            else:
+                rows = values[:,index]
+            for r,row in enumerate(rows):
+                references[r].append(np.sort(row[~np.isnan(row)].astype(np.float32)))
+        return references
+
+    def sufficient_entries(self,rows,labels,values,n_rows,n_groups,bins):
+        # n, sum log x, sum log(1-x) (of the transformed values fit_beta uses) and median sketch counts
+        # per (row,group) from entries of rows with group labels (-1 for samples of no group)
+        transformed = self.beta.transform(values)
+        keep = (labels >= 0) & ~np.isnan(transformed)
+        rows,labels,values,transformed = rows[keep],labels[keep],values[keep],transformed[keep]
+        flat = rows * n_groups + labels
+        size = n_rows * n_groups
+        n = np.bincount(flat,minlength=size).reshape(n_rows,n_groups)
+        sum_log = np.bincount(flat,np.log(transformed),minlength=size).reshape(n_rows,n_groups)
+        sum_log1m = np.bincount(flat,np.log1p(-transformed),minlength=size).reshape(n_rows,n_groups)
+        sketch = Sketch(n_rows,n_groups,bins=bins).add_entries(rows,labels,values)
+        return n,sum_log,sum_log1m,sketch.counts
+
+    def reference_sufficient(self,reference_stats,n_groups,bins):
+        # Sufficient statistics of the reference values kept by fit_beta
+        intervals = list(reference_stats.keys())
+        references = [values for interval in intervals for values in reference_stats[interval]]
+        cells = np.repeat(np.arange(len(references)),[len(values) for values in references])
+        values = np.concatenate([np.zeros(0)] + references).astype(float)
+        return intervals,self.sufficient_entries(cells // n_groups,cells % n_groups,values,len(intervals),n_groups,bins)
+
+    def block_update(self,item,info):
+        i,positions,values = item
+        labels,n_groups,bins = info
+        values = Table.decode(Table.load(values))
+        if isinstance(values,SparseBlock):
+            rows,columns,entries = values.row_ids(),values.indices,values.data
+        else:
+            rows,columns = np.nonzero(~np.isnan(values))
+            entries = values[rows,columns]
+        return i,positions,self.sufficient_entries(rows,labels[columns],entries,len(positions),n_groups,bins)
+
+    def update(self,ps_table,groups,beta_stats,sufficient):
+        # Adds the new samples' values to the sufficient statistics and refits the (interval,group) cells
+        # that received values: beta MLE from mean log x and mean log(1-x), median from the sketch
+        n,sum_log,sum_log1m,counts = (np.array(x) for x in sufficient)
+        samples = ps_table.get_samples()
+        slots = {group:g for g,group in enumerate(groups)}
+        labels = np.array([slots.get(self.get_group.get(sample),-1) for sample in samples])
+        unknown = sorted({self.get_group[sample] for sample in samples if sample in self.get_group} - set(groups))
+        if unknown:
+            print(f"Skipping samples of groups not in the signature: {', '.join(unknown)}")
+        intervals = list(beta_stats.keys())
+        position = np.full(len(self.catalog),-1)
+        position[intervals] = np.arange(len(intervals))
+        bins = counts.shape[-1]
+        added = np.zeros(n.shape,dtype=np.int64)
+        for i,positions,(block_n,block_log,block_log1m,block_counts) in self.run_blocks(
+                "update",partial(self.indexed_blocks,ps_table),position,self.block_update,(labels,len(groups),bins)):
+            added[positions] += block_n
+            sum_log[positions] += block_log
+            sum_log1m[positions] += block_log1m
+            counts[positions] += block_counts
+        n += added
+        with np.errstate(divide="ignore",invalid="ignore"):
+            a,b = Beta.fit_sufficient(sum_log / n,sum_log1m / n)
+        sketch = Sketch(0,len(groups),bins=bins)
+        medians = sketch.median(np.cumsum(counts,axis=-1))
+        updated = {}
+        for r,interval in enumerate(intervals):
+            updated[interval] = [[float(medians[r,g]),float(a[r,g]),float(b[r,g])] if added[r,g] else list(mab[:3])
+                                 for g,mab in enumerate(beta_stats[interval])]
+        print(f"Added {int(added.sum())} values from {int((labels >= 0).sum())} samples; "
+              f"refitted {int((added > 0).sum())} of {added.size} interval groups")
+        return updated,(n,sum_log,sum_log1m,counts)
+
+    def fit_rows(self,values,group_indices,bootstrap=None):
+        mabs = [[] for r in range(len(values))]
+        for g,index in enumerate(group_indices.values()):
+            if isinstance(values,SparseBlock):
+                # Only the observed values of each row
+                group_values = values.select(index)
+                rows = np.split(group_values.data,group_values.indptr[1:-1])
+            else:
+                group_values = values[:,index]
+                rows = group_values
+            for r,row in enumerate(rows):
+                mabs[r].append(list(self.beta.fit_beta(row)))
+            if bootstrap:
+                if isinstance(group_values,SparseBlock):
+                    group_values = group_values.dense()
+                cis = bootstrap.beta_ci(group_values,self.beta,stream=g)
+                for r in range(len(values)):
+                    mabs[r][g].extend(float(x[r]) for x in cis)
+        return mabs
+
+    def select_betas(self,compare_stats,candidate_stats):
+        # Fits made during the compare pass, for the intervals that pass FDR
+        interval_set = self.significant_intervals(compare_stats)
+        print("significant intervals:",len(interval_set))
+        beta_stats,reference_stats = {},{}
+        for interval,(mabs,references) in candidate_stats.items():
+            if interval in interval_set:
+                beta_stats[interval] = mabs
+                reference_stats[interval] = references
+        return beta_stats,reference_stats
 
-    def fit_betas(self,ps_table,compare_stats):
+    def fit_betas(self,ps_table,compare_stats,bootstrap=None,ecdf=False):
         interval_set = self.significant_intervals(compare_stats)
         print("significant intervals:",len(interval_set))
         group_indices = self.get_group_indices(ps_table.get_samples())
-        beta_stats = {}
-        import multiprocessing
-        n = self.n_threads
-        buffer_ratio = 10
-        with multiprocessing.Manager() as manager:
-            q1 = manager.Queue(maxsize = n * buffer_ratio)
-            q2 = manager.Queue()
-            o = manager.dict()
-            read_process = multiprocessing.Process(target=Multi.mp_reader,
-                                                   args=(ps_table.get_rows,interval_set,q1,n))
-            read_process.start()
-            pool = [multiprocessing.Process(target=Multi.mp_do_rows,args=(q1,self.row_fit_beta,group_indices,q2)) for n in range(n-2)] 
-            for p in pool:
-                p.start()
-            done_count = 0
-            while True:
-                item = q2.get()
-                if item == "DONE":
-                    done_count += 1
-                    if done_count == n-2:
-                        break
-                    continue
-                beta_stats[item[0]] = item[1]
-            read_process.join()
-            for p in pool:
-                p.join()
-        return beta_stats
+        beta_stats,reference_stats = {},{}
+        results = self.run_blocks("fit_beta",ps_table.get_blocks,interval_set,self.block_fit_beta,(group_indices,bootstrap,ecdf))
+        for i,rows in results:
+            for interval,mab_row,references in rows:
+                beta_stats[interval] = mab_row
+                reference_stats[interval] = references
+        return beta_stats,reference_stats
     
-    def row_query_beta(self,row,beta_stats):
-        interval,values = row
-        probabilities = []
-        for mab in beta_stats[interval]:
-            if None in mab:
-                probabilities.append([float('nan') for i in range(len(values))])
-                continue
-            m,a,b = mab
-            sub_probs = []
-            for x in values:
-                sub_probs.append(self.beta.cdf(x,m,a,b))
-            probabilities.append(sub_probs)
-        return probabilities
-
-    def query(self,ps_table,groups,beta_stats):
-        import multiprocessing
-        interval_set = set(beta_stats.keys())
-        n = self.n_threads
-        buffer_ratio = 8
-        with multiprocessing.Manager() as manager:
-            q1 = manager.Queue(maxsize = n * buffer_ratio)
-            q2 = manager.Queue()
-            samples = ps_table.get_samples()
-            probs_by_sample = [[[] for j in range(len(samples))] for i in range(len(groups))]
-            read_process = multiprocessing.Process(target=Multi.mp_reader,args=(ps_table.get_rows,interval_set,q1,n))
-            read_process.start()
-            pool = [multiprocessing.Process(target=Multi.mp_do_rows,args=(q1,self.row_query_beta,beta_stats,q2)) for n in range(n-2)] 
-            for p in pool:
-                p.start()
-            done_count = 0
-            loop_count = 0
-            while True:
-                item = q2.get()
-                if item == "DONE":
-                    done_count += 1
-                    if done_count == n-2:
-                        break
-                    continue
-                for i,sub_probs in enumerate(item):
-                    for j,prob in enumerate(sub_probs):
-                        probs_by_sample[i][j].append(prob)
-                loop_count += 1
-            read_process.join()
-            for p in pool:
-                p.join()
+    def indexed_blocks(self,ps_table,position,skip=None):
+        # Blocks of signature intervals with their row positions in the signature arrays (position by catalog ID)
+        for i,intervals,values in ps_table.get_blocks(np.flatnonzero(position >= 0),skip=skip):
+            yield i,position[intervals],values
+
+    def block_query_beta(self,item,info):
+        i,positions,values = item
+        model,dtype,source_dtype,table,ecdf = info
+        values = Table.load(values)
+        stored = values.dtype
+        values = Table.decode(values)
+        mabs = model.array[positions]
+        m,a,b = (mabs[:,:,k].T[:,:,None] for k in range(3))
+        # Round medians like the values, to the file's type and then the block type, so that x == m still matches
+        for rounding in (source_dtype,stored):
+            m = Table.decode(Table.encode(m,"uint16" if rounding == np.uint16 else rounding))
+        if ecdf:
+            keys,offsets,segments = ecdf
+            segments = segments.array[positions].T
+            if isinstance(values,SparseBlock):
+                rows = values.row_ids()
+                probabilities = np.full((mabs.shape[1],len(values),values.n_samples),np.nan)
+                probabilities[:,rows,values.indices] = ECDF.tail(keys.array,offsets.array,segments[:,rows],
+                                                                 values.data[None],m[:,rows,0])
+            else:
+                probabilities = ECDF.tail(keys.array,offsets.array,segments[:,:,None],values[None],m)
+        elif isinstance(values,SparseBlock) and not table:
+            # Tail probabilities of the observed values only; the rest stay NaN
+            rows = values.row_ids()
+            probabilities = np.full((mabs.shape[1],len(values),values.n_samples),np.nan)
+            probabilities[:,rows,values.indices] = self.beta.tail(values.data[None],m[:,rows,0],a[:,rows,0],b[:,rows,0])
+        elif table:
+            dense = values.dense() if isinstance(values,SparseBlock) else values
+            probabilities = Beta.table_tail(table.array[positions],dense,m)
+        else:
+            probabilities = self.beta.tail(values[None],m,a,b)
+        return i,positions,Table.encode(probabilities,"float32" if dtype == "uint16" else dtype)
+
+    def query(self,ps_tables,signatures,cdfs=None,ecdfs=None):
+        # Signatures share one model over the union of their intervals, each with its own group slots,
+        # so that every PS table is read once for all of them
+        index = {}
+        for groups,beta_stats in signatures:
+            for interval in beta_stats:
+                if interval not in index:
+                    index[interval] = len(index)
+        position = np.full(len(self.catalog),-1)
+        position[list(index)] = np.arange(len(index))
+        offsets = np.cumsum([0] + [len(groups) for groups,beta_stats in signatures])
+        model = SharedArray((len(index),offsets[-1],3))
+        model.array[...] = np.nan
+        table = None
+        if cdfs:
+            grid_size = cdfs[0]["table"].shape[-1]
+            if any(cdf["table"].shape[-1] != grid_size for cdf in cdfs):
+                exit("cdf tables need the same grid size")
+            table = SharedArray((len(index),offsets[-1],grid_size),np.float32)
+            table.array[...] = np.nan
+        for s,(groups,beta_stats) in enumerate(signatures):
+            intervals = list(beta_stats.keys())
+            rows = [index[interval] for interval in intervals]
+            mabs = np.array([[mab[:3] for mab in beta_stats[interval]] for interval in intervals],dtype=float)
+            model.array[rows,offsets[s]:offsets[s+1]] = mabs.reshape(len(intervals),len(groups),3)
+            if table:
+                table.array[rows,offsets[s]:offsets[s+1]] = cdfs[s]["table"][[cdfs[s]["index"][interval] for interval in intervals]]
+        ecdf = None
+        if ecdfs:
+            # Reference segments of all signatures in one key array; segments maps model slots to them
+            segments = SharedArray((len(index),offsets[-1]),np.int64)
+            segments.array[...] = -1
+            values,bounds,base,n_segments = [],[np.zeros(1,dtype=np.int64)],0,0
+            for s,(groups,beta_stats) in enumerate(signatures):
+                intervals = list(beta_stats.keys())
+                rows = [index[interval] for interval in intervals]
+                references = np.array([ecdfs[s]["index"][interval] for interval in intervals],dtype=np.int64)
+                segments.array[rows,offsets[s]:offsets[s+1]] = n_segments + references[:,None] * len(groups) + np.arange(len(groups))
+                values.append(ecdfs[s]["values"])
+                bounds.append(base + ecdfs[s]["offsets"][1:])
+                base += len(ecdfs[s]["values"])
+                n_segments += len(ecdfs[s]["offsets"]) - 1
+            bounds = np.concatenate(bounds)
+            ecdf = (SharedArray.copy(ECDF.keys(np.concatenate(values),bounds)),SharedArray.copy(bounds),segments)
+        samples = []
+        signature_pvals = [([],[[] for k in range(len(groups)*(len(groups)-1))]) for groups,beta_stats in signatures]
+        try:
+            for t,ps_table in enumerate(ps_tables):
+                table_samples = ps_table.get_samples()
+                samples.extend(table_samples)
+                stage = "query" if len(ps_tables) == 1 else f"query{t+1}"
+                results = self.run_blocks(stage,partial(self.indexed_blocks,ps_table),position,self.block_query_beta,
+                                          (model,ps_table.dtype,ps_table.source_dtype(),table,ecdf),buffer_ratio=8)
+                positions = np.concatenate([block_positions for i,block_positions,probabilities in results] + [np.zeros(0,dtype=int)])
+                for s,(groups,beta_stats) in enumerate(signatures):
+                    rows = np.flatnonzero(np.isin(positions,[index[interval] for interval in beta_stats]))
+                    probs_by_sample = np.zeros((len(groups),0,len(table_samples)))
+                    if results:
+                        probs_by_sample = np.concatenate([probabilities[offsets[s]:offsets[s+1]]
+                                                          for i,block_positions,probabilities in results],axis=1)[:,rows]
+                    queries,pvals = self.pairwise_pvals(groups,probs_by_sample)
+                    signature_pvals[s] = (queries,[previous + p for previous,p in zip(signature_pvals[s][1],pvals)])
+        finally:
+            for shared in (model,table) + (ecdf or ()):
+                if shared:
+                    shared.close()
+        return samples,signature_pvals
+
+    def pairwise_pvals(self,groups,probs_by_sample):
+        from scipy.stats import ranksums
         pvals = []
         queries = []
-
         for i,group_of_probs in enumerate(probs_by_sample):
             for j in range(i+1,len(probs_by_sample)):
                 comp_group_probs = probs_by_sample[j]
@@ -411,14 +817,84 @@ class Manifest:
                 queries.append(f"{groups[j]}_over_{groups[i]}")
                 first_pvals = []
                 second_pvals = []
-                for first,second in zip(group_of_probs,comp_group_probs):
+                for first,second in zip(Table.decode(group_of_probs).T,Table.decode(comp_group_probs).T):
                     s,pval = ranksums(first,second,alternative="greater",nan_policy="omit")
                     first_pvals.append(pval)
                     s,pval = ranksums(second,first,alternative="greater",nan_policy="omit")
                     second_pvals.append(pval)
                 pvals.extend([first_pvals,second_pvals])
+        return queries,pvals
+
+    @staticmethod
+    def row_correlations(values):
+        # Pearson correlations between rows over the columns observed in both rows (NaN with fewer than 3)
+        observed = ~np.isnan(values)
+        x = np.where(observed,values,0)
+        m = observed.astype(float)
+        n,s,q = m @ m.T,x @ m.T,(x * x) @ m.T
+        with np.errstate(divide="ignore",invalid="ignore"):
+            r = (n * (x @ x.T) - s * s.T) / np.sqrt((n * q - s * s) * (n * q.T - s.T * s.T))
+        return np.where(n > 2,r,np.nan)
 
-        return samples,queries,pvals
+    @staticmethod
+    def representatives(correlations,cutoff):
+        # Greedy pass over rows in priority order: a row is kept unless it correlates with one already kept
+        kept = []
+        for k in range(len(correlations)):
+            if not kept or not (np.abs(correlations[k,kept]) >= cutoff).any():
+                kept.append(k)
+        return kept
+
+    def call_accuracy(self,groups,pvals,labels):
+        # Fraction of correct calls for the pairwise queries (order of pairwise_pvals) that involve a
+        # sample's own group: significant for "own over other", not significant for "other over own"
+        pairs = [pair for i in range(len(groups)) for j in range(i+1,len(groups)) for pair in ((i,j),(j,i))]
+        correct = []
+        for (i,j),p in zip(pairs,np.asarray(pvals).reshape(len(pairs),-1)):
+            correct.extend(p[labels == groups[i]] < self.threshold)
+            correct.extend(p[labels == groups[j]] >= self.threshold)
+        return float(np.mean(correct)) if correct else 1.0
+
+    def compact(self,ps_table,groups,beta_stats,cutoffs=(0.5,0.6,0.7,0.8,0.9,0.95),max_accuracy_loss=0.01):
+        # Overlapping intervals whose reference PS values correlate carry the same information; keep the
+        # interval with the largest median separation of each correlated set, at the most aggressive cutoff
+        # whose query calls on the reference samples lose at most max_accuracy_loss against the full signature
+        samples = ps_table.get_samples()
+        sample_groups = np.array([self.get_group.get(sample,"") for sample in samples])
+        intervals = np.array(list(beta_stats.keys()),dtype=np.int64)
+        position = np.full(len(self.catalog),-1)
+        position[intervals] = np.arange(len(intervals))
+        values = np.full((len(intervals),len(samples)),np.nan)
+        for i,rows,block in self.indexed_blocks(ps_table,position):
+            block = Table.decode(Table.load(block))
+            values[rows] = block.dense() if isinstance(block,SparseBlock) else block
+        mabs = np.array([[mab[:3] for mab in beta_stats[interval]] for interval in intervals.tolist()],dtype=float)
+        mabs = mabs.reshape(len(intervals),len(groups),3)
+        separation = np.nanmax(mabs[:,:,0],axis=1) - np.nanmin(mabs[:,:,0],axis=1)
+        labels = self.catalog.clusters(intervals)
+        order = np.lexsort((np.arange(len(intervals)),-np.nan_to_num(separation,nan=-1),labels))
+        bounds = np.flatnonzero(np.diff(labels[order],prepend=-1,append=-1))
+        clusters = [order[start:stop] for start,stop in zip(bounds[:-1],bounds[1:]) if stop - start > 1]
+        correlations = [self.row_correlations(values[members]) for members in clusters]
+        probabilities = self.beta.tail(values[None],*(mabs[:,:,k].T[:,:,None] for k in range(3)))
+        full_accuracy = self.call_accuracy(groups,self.pairwise_pvals(groups,probabilities)[1],sample_groups)
+        print(f"Full signature: {len(intervals)} intervals, accuracy {full_accuracy:.2%}")
+        singles = np.ones(len(intervals),dtype=bool)
+        for members in clusters:
+            singles[members] = False
+        for cutoff in sorted(cutoffs):
+            kept = np.sort(np.concatenate([np.flatnonzero(singles)] + [members[self.representatives(r,cutoff)]
+                                                                         for members,r in zip(clusters,correlations)]))
+            accuracy = self.call_accuracy(groups,self.pairwise_pvals(groups,probabilities[:,kept])[1],sample_groups)
+            print(f"Correlation cutoff {cutoff}: {len(kept)} intervals, accuracy {accuracy:.2%}")
+            if full_accuracy - accuracy <= max_accuracy_loss:
+                keep = kept
+                break
+        else:
+            keep = np.arange(len(intervals))
+            print("No cutoff stays within the accuracy loss limit; keeping the full signature")
+        print(f"Kept {len(keep)} of {len(intervals)} intervals in {len(np.unique(labels))} clusters")
+        return {interval:beta_stats[interval] for interval in intervals[keep].tolist()}
        
 # Run main
 if __name__ == "__main__":
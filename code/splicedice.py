@@ -1 +1,43 @@
+# Splice DICE command-line entry point
+# Subcommand modules are only imported once the mode is known, so that
+# `--help` and quick jobs don't pay for scipy/matplotlib imports.
+import sys
 
+## mode: (module, keep mode as first argument, description)
+subcommands = {
+    "compare":("signature",True,"Test for differential splicing between manifest groups (.sig.tsv)."),
+    "fit_beta":("signature",True,"Fit beta distributions for significant intervals (.beta.tsv)."),
+    "query":("signature",True,"Query new samples against a splicing signature (.pvals.tsv)."),
+    "compact":("signature",True,"Drop redundant correlated overlapping intervals from a signature (.beta.tsv)."),
+    "update":("signature",True,"Add samples to a signature from its sufficient statistics (.beta.tsv, .suff.npz)."),
+    "store":("signature",True,"Convert a PS table to a binary .ps.npy store."),
+    "distance":("distance",False,"Sample x sample Pearson or Euclidean distances with optional clustering (.dist.npz)."),
+    "aggregate":("aggregate",False,"Build a junction x sample count matrix from per-sample junction files (.counts.csr.npz)."),
+    "plot":("plot",False,"Plot query match tables and PS value distributions."),
+    "benchmark":("benchmark",False,"Time startup and each pipeline stage."),
+}
+
+def print_usage(out=sys.stdout):
+    out.write("usage: splicedice.py <mode> [options]\n\nmodes:\n")
+    for mode,(module,keep,description) in subcommands.items():
+        out.write(f"  {mode:<12}{description}\n")
+    out.write("\nRun 'splicedice.py <mode> -h' for the options of each mode.\n")
+
+def main(argv=None):
+    if argv is None:
+        argv = sys.argv[1:]
+    if not argv or argv[0] in ("-h","--help"):
+        print_usage()
+        return None
+    mode = argv[0]
+    if mode not in subcommands:
+        sys.stderr.write(f"splicedice.py: unknown mode '{mode}'\n")
+        print_usage(sys.stderr)
+        sys.exit(2)
+    module_name,keep,description = subcommands[mode]
+    import importlib
+    module = importlib.import_module(module_name)
+    return module.main(argv if keep else argv[1:])
+
+if __name__ == "__main__":
+    main()
@@ -1,4 +1,6 @@
-from scipy.stats import beta as stats_beta
+import os
+import time
+import warnings
 import numpy as np
 
 class Manifest:
@@ -27,7 +29,8 @@ class Manifest:
         if anti:
             anti_indices = {}
             for name,group in group_indices.items():
-                anti_indices[name]  = [i for i,s in enumerate(samples) if s not in group]
+                group = set(group)
+                anti_indices[name]  = [i for i in range(len(samples)) if i not in group]
             return group_indices, anti_indices
         else:
             return group_indices
@@ -44,7 +47,47 @@ class Beta:
             self.loc = -0.001
             self.scale = 1.002
 
+    def tail(self,x,m,a,b):
+        # Vectorized cdf(): lower tail below the median, upper tail above it
+        from scipy.stats import beta as stats_beta
+        lower = stats_beta.cdf(x,a,b,loc=self.loc,scale=self.scale)
+        return np.where(x == m,1.0,np.where(x > m,1-lower,lower))
+
+    def cdf_table(self,a,b,grid_size=1001,chunk_size=1000):
+        # Lower cdf of each (a,b) pair on an even grid over [0,1], with the interpolation error at cell midpoints
+        from scipy.stats import beta as stats_beta
+        a,b = np.asarray(a,dtype=float),np.asarray(b,dtype=float)
+        grid = np.linspace(0,1,grid_size)
+        midpoints = (grid[:-1] + grid[1:]) / 2
+        table = np.empty(a.shape + (grid_size,),dtype=np.float32)
+        errors = np.empty(a.shape)
+        for start in range(0,len(a),chunk_size):
+            end = start + chunk_size
+            chunk_a,chunk_b = a[start:end,...,None],b[start:end,...,None]
+            lower = stats_beta.cdf(grid,chunk_a,chunk_b,loc=self.loc,scale=self.scale)
+            table[start:end] = lower
+            lower = table[start:end].astype(float)
+            middle = stats_beta.cdf(midpoints,chunk_a,chunk_b,loc=self.loc,scale=self.scale)
+            errors[start:end] = np.abs(middle - (lower[...,:-1] + lower[...,1:]) / 2).max(axis=-1,initial=0)
+        return table,errors
+
+    @staticmethod
+    def table_tail(table,x,m):
+        # tail() by linear interpolation in cdf tables: table is (rows,groups,grid), x (rows,samples), m (groups,rows,1)
+        grid_size = table.shape[-1]
+        missing = np.isnan(x)
+        position = np.clip(np.where(missing,0,x),0,1) * (grid_size-1)
+        k = np.minimum(position.astype(np.intp),grid_size-2)
+        w = (position - k)[None]
+        k = np.broadcast_to(k[:,None,:],(table.shape[0],table.shape[1],x.shape[1]))
+        left = np.take_along_axis(table,k,axis=2).transpose(1,0,2)
+        right = np.take_along_axis(table,k+1,axis=2).transpose(1,0,2)
+        lower = left + w * (right - left)
+        lower[:,missing] = np.nan
+        return np.where(x[None] == m,1.0,np.where(x[None] > m,1-lower,lower))
+
     def cdf(self,x,m,a,b):
+        from scipy.stats import beta as stats_beta
         if x == m:
             return 1
         else:
@@ -54,9 +97,10 @@ class Beta:
                 return stats_beta.cdf(x,a,b,loc=self.loc,scale=self.scale)
 
     def fit_beta(self,values):
+        from scipy.stats import beta as stats_beta
         values = [x for x in values if not np.isnan(x)]
         if not values:
-            return (None,None,(None,None,None))
+            return (None,None,None)
         if self.exclude:
             values = [x for x in values if x != 0 and x != 1]
         try:
@@ -64,13 +108,158 @@ class Beta:
         except:
             a,b = None,None 
         return (np.median(values),a,b)
+
+    def transform(self,values):
+        values = np.asarray(values,dtype=float)
+        if self.exclude:
+            values = np.where((values == 0) | (values == 1),np.nan,values)
+        return (values - self.loc) / self.scale
+
+    @staticmethod
+    def fit_sufficient(mean_log,mean_log1m,iterations=30):
+        # Beta MLE from mean log(x) and mean log(1-x) by Newton's method, vectorized over any shape
+        from scipy.special import digamma,polygamma
+        mean_log,mean_log1m = np.broadcast_arrays(np.asarray(mean_log,dtype=float),np.asarray(mean_log1m,dtype=float))
+        g1,g2 = np.exp(mean_log),np.exp(mean_log1m)
+        # No MLE without spread in the values (g1 + g2 == 1)
+        active = np.flatnonzero(np.isfinite(g1+g2) & (g1+g2 < 1-1e-12))
+        a = np.full(mean_log.shape,np.nan)
+        b = np.full(mean_log.shape,np.nan)
+        a.flat[active] = 0.5 + g1.flat[active] / (2*(1-g1.flat[active]-g2.flat[active]))
+        b.flat[active] = 0.5 + g2.flat[active] / (2*(1-g1.flat[active]-g2.flat[active]))
+        for i in range(iterations):
+            if not len(active):
+                break
+            x,y = a.flat[active],b.flat[active]
+            psi = digamma(x+y)
+            f1 = digamma(x) - psi - mean_log.flat[active]
+            f2 = digamma(y) - psi - mean_log1m.flat[active]
+            t = polygamma(1,x+y)
+            h11,h22 = polygamma(1,x)-t,polygamma(1,y)-t
+            det = h11*h22 - t*t
+            step_a,step_b = (h22*f1 + t*f2)/det,(h11*f2 + t*f1)/det
+            a.flat[active] = np.maximum(x - step_a,1e-8)
+            b.flat[active] = np.maximum(y - step_b,1e-8)
+            active = active[(np.abs(step_a) > 1e-9*x) | (np.abs(step_b) > 1e-9*y)]
+        return a,b
+
+#### Bootstrap Class ####
+class Bootstrap:
+    def __init__(self,n_iters=1000,seed=0,confidence=0.95,max_elements=2e7):
+        self.n_iters = n_iters
+        self.seed = seed
+        self.tails = [50*(1-confidence),100-50*(1-confidence)]
+        self.max_elements = max_elements
+
+    def resamples(self,n_rows,sizes,stream=0):
+        # Index batches over the iteration budget; the same seeded stream is drawn for every block
+        rngs = [np.random.default_rng([self.seed,stream,k]) for k in range(len(sizes))]
+        batch = max(1,int(self.max_elements // max(1,n_rows*sum(sizes))))
+        for start in range(0,self.n_iters,batch):
+            b = min(batch,self.n_iters-start)
+            yield [rng.integers(0,max(1,n),(b,n)) for rng,n in zip(rngs,sizes)]
+
+    def median_delta_ci(self,group_values,rest_values,stream=0):
+        deltas = []
+        for g,r in self.resamples(len(group_values),[group_values.shape[1],rest_values.shape[1]],stream):
+            deltas.append(np.nanmedian(group_values[:,g],axis=2) - np.nanmedian(rest_values[:,r],axis=2))
+        low,high = np.nanpercentile(np.concatenate(deltas,axis=1),self.tails,axis=1)
+        return low,high
+
+    def beta_ci(self,values,beta,stream=0):
+        y = beta.transform(values)
+        logs = np.log(y)
+        logs1m = np.log(1-y)
+        alphas,betas = [],[]
+        for (index,) in self.resamples(len(values),[values.shape[1]],stream):
+            a,b = beta.fit_sufficient(np.nanmean(logs[:,index],axis=2),np.nanmean(logs1m[:,index],axis=2))
+            alphas.append(a)
+            betas.append(b)
+        alpha_low,alpha_high = np.nanpercentile(np.concatenate(alphas,axis=1),self.tails,axis=1)
+        beta_low,beta_high = np.nanpercentile(np.concatenate(betas,axis=1),self.tails,axis=1)
+        return alpha_low,alpha_high,beta_low,beta_high
     
+#### Sketch Class ####
+# Quantile sketch of PS values: counts in equal-width bins over [0,1] for each row and label.
+# Order statistics are placed within their bin, so quantiles are within 1/bins of the exact value.
+# Counts add up, so column chunks of a block (and update's new samples) are added to the same counts.
+class Sketch:
+    def __init__(self,n_rows,n_labels,error=0.005,bins=None):
+        # bins overrides error, for sketches that must match stored counts
+        self.bins = bins or self.n_bins(error)
+        self.n_labels = n_labels
+        self.counts = np.zeros((n_rows,n_labels,self.bins),dtype=np.int32)
+
+    @staticmethod
+    def n_bins(error):
+        return int(np.ceil(1/error))
+
+    def add_entries(self,rows,labels,values):
+        keep = (labels >= 0) & ~np.isnan(values)
+        rows,labels,values = rows[keep],labels[keep],values[keep]
+        b = np.clip((values * self.bins).astype(np.int64),0,self.bins-1)
+        flat = (rows * self.n_labels + labels) * self.bins + b
+        self.counts += np.bincount(flat,minlength=self.counts.size).reshape(self.counts.shape)
+        return self
+
+    def add(self,values,labels,column_chunk=4096):
+        # One streaming pass over column chunks of a dense (rows x samples) block or a SparseBlock
+        if isinstance(values,SparseBlock):
+            return self.add_entries(values.row_ids(),labels[values.indices],Table.decode(values.data))
+        rows = np.arange(len(values))
+        for start in range(0,values.shape[1],column_chunk):
+            chunk = Table.decode(values[:,start:start+column_chunk])
+            self.add_entries(np.repeat(rows,chunk.shape[1]),np.tile(labels[start:start+column_chunk],len(rows)),chunk.ravel())
+        return self
+
+    def order_statistic(self,cumulative,rank):
+        # Value of the rank-th smallest entry (1-based), spread evenly within its bin
+        k = np.minimum((cumulative < rank[...,None]).sum(axis=-1),self.bins-1)
+        upto = np.take_along_axis(cumulative,k[...,None],axis=-1)[...,0]
+        below = np.take_along_axis(cumulative,np.maximum(k-1,0)[...,None],axis=-1)[...,0] * (k > 0)
+        return (k + (rank - below - 0.5) / np.maximum(upto - below,1)) / self.bins
+
+    def median(self,cumulative):
+        n = cumulative[...,-1]
+        medians = (self.order_statistic(cumulative,(n+1)//2) + self.order_statistic(cumulative,(n+2)//2)) / 2
+        medians[n == 0] = np.nan
+        return medians
+
+    def medians(self,n_groups):
+        # Medians of each group and of everything but the group (cumulative counts subtract like counts)
+        cumulative = np.cumsum(self.counts,axis=-1)
+        total = cumulative.sum(axis=1)
+        medians = self.median(cumulative[:,:n_groups])
+        rest_medians = self.median(total[:,None,:] - cumulative[:,:n_groups])
+        return medians,rest_medians
+
 #### Multi Class ####        
 class Multi:
 
     @staticmethod
-    def mp_reader(read_function,info,q,n): 
-        for item in read_function(info):
+    def n_threads(value):
+        # -n takes a number of processes or "auto"
+        return value if value == "auto" else int(value)
+
+    @staticmethod
+    def add_arguments(parser,backend=True):
+        # -n and --backend of the modes that run their work through Multi.run
+        parser.add_argument("-n","--n_threads",default=4,type=Multi.n_threads,
+                            help="Maximum number of processes to use at the same time, or 'auto' to use the CPUs available "
+                                 "to the job (including cgroup limits) and size work items from measured compute times.")
+        if backend:
+            parser.add_argument("--backend",default="process",choices=["process","thread","serial"],
+                                help="Run blocks in worker processes, in threads of this process that share the blocks and "
+                                     "parameters without pickling (NumPy kernels release the GIL), or serially.")
+
+    @staticmethod
+    def read_items(read_function,info,skip=None):
+        # Items of read functions that take a skip set of finished block numbers
+        return read_function(info,skip=skip) if skip else read_function(info)
+
+    @staticmethod
+    def mp_reader(read_function,info,q,n,skip=None):
+        for item in Multi.read_items(read_function,info,skip):
             q.put(item)
 
         for i in range(n):
@@ -87,26 +276,829 @@ class Multi:
             o.put(f(item,info))
         return None
 
+    @staticmethod
+    def guarded(target,o,*args):
+        # Thread or process target whose exception goes to the output queue, for the consumer to raise
+        try:
+            target(*args)
+        except BaseException as error:
+            o.put(error)
+
+    @staticmethod
+    def reader_thread(read_function,info,q,n,skip,o,reader=None):
+        # Readers run as threads of the calling process, so that catalog IDs they intern while reading are kept
+        import threading
+        thread = threading.Thread(target=Multi.guarded,daemon=True,
+                                  args=(reader or Multi.mp_reader,o,read_function,info,q,n,skip))
+        thread.start()
+        return thread
+
+    @staticmethod
+    def run_threads(read_function,read_info,f,info,n,buffer_ratio=10,skip=None):
+        # Worker threads get info and the blocks in place, without pickling; the NumPy kernels release the GIL
+        import queue
+        import threading
+        q1 = queue.Queue(maxsize = n * buffer_ratio)
+        q2 = queue.Queue()
+        threads = [threading.Thread(target=Multi.guarded,args=(Multi.mp_do_rows,q2,q1,f,info,q2),daemon=True) for i in range(n)]
+        for thread in threads:
+            thread.start()
+        threads.append(Multi.reader_thread(read_function,read_info,q1,n,skip,q2))
+        done_count = 0
+        while done_count < n:
+            item = q2.get()
+            if isinstance(item,BaseException):
+                raise item
+            if isinstance(item,str) and item == "DONE":
+                done_count += 1
+                continue
+            yield item
+        for thread in threads:
+            thread.join()
+
+    @staticmethod
+    def run(read_function,read_info,f,info,n,buffer_ratio=10,skip=None,backend="process"):
+        # backend: "process" (worker processes, -n auto uses the Scheduler), "thread" or "serial" (in this process)
+        if backend == "serial":
+            for item in Multi.read_items(read_function,read_info,skip):
+                yield f(item,info)
+            return None
+        if backend == "thread":
+            n = Scheduler.available_cpus() if n == "auto" else max(1,n-1)
+            yield from Multi.run_threads(read_function,read_info,f,info,n,buffer_ratio,skip)
+            return None
+        if n == "auto":
+            yield from Scheduler().run(read_function,read_info,f,info,buffer_ratio,skip)
+            return None
+        import multiprocessing
+        n_workers = max(1,n-2)
+        with multiprocessing.Manager() as manager:
+            q1 = manager.Queue(maxsize = n * buffer_ratio)
+            q2 = manager.Queue()
+            pool = [multiprocessing.Process(target=Multi.guarded,args=(Multi.mp_do_rows,q2,q1,f,info,q2)) for i in range(n_workers)]
+            for p in pool:
+                p.start()
+            # Workers are started before the reader thread, so that they don't fork while it holds locks
+            read_thread = Multi.reader_thread(read_function,read_info,q1,n_workers,skip,q2)
+            done_count = 0
+            while True:
+                item = q2.get()
+                if isinstance(item,BaseException):
+                    raise item
+                if item == "DONE":
+                    done_count += 1
+                    if done_count == n_workers:
+                        break
+                    continue
+                yield item
+            read_thread.join()
+            for p in pool:
+                p.join()
+
+#### Scheduler Class ####
+# -n auto: workers for the CPUs this process may use (no more than one reader keeps busy), a serial in-process
+# start that finishes small inputs without starting processes, and queue items of several blocks sized from
+# the measured compute and read time per block
+class Scheduler:
+    def __init__(self,target_seconds=0.2,serial_seconds=1.0,max_batch=64,memory_fraction=0.25):
+        self.target_seconds = target_seconds
+        self.serial_seconds = serial_seconds
+        self.max_batch = max_batch
+        self.memory_fraction = memory_fraction
+
+    @staticmethod
+    def read_limit(filename):
+        try:
+            with open(filename) as limit_file:
+                return limit_file.read().split()
+        except OSError:
+            return None
+
+    @staticmethod
+    def available_cpus():
+        try:
+            cpus = len(os.sched_getaffinity(0))
+        except AttributeError:
+            cpus = os.cpu_count() or 1
+        quota = None
+        limit = Scheduler.read_limit("/sys/fs/cgroup/cpu.max")
+        if limit and limit[0] != "max":
+            quota = int(limit[0]) / int(limit[1])
+        else:
+            limit,period = Scheduler.read_limit("/sys/fs/cgroup/cpu/cpu.cfs_quota_us"),Scheduler.read_limit("/sys/fs/cgroup/cpu/cpu.cfs_period_us")
+            if limit and period and int(limit[0]) > 0:
+                quota = int(limit[0]) / int(period[0])
+        if quota:
+            cpus = min(cpus,max(1,int(quota)))
+        return cpus
+
+    @staticmethod
+    def available_memory():
+        limits = []
+        try:
+            limits.append(os.sysconf("SC_PAGE_SIZE") * os.sysconf("SC_AVPHYS_PAGES"))
+        except (ValueError,OSError,AttributeError):
+            pass
+        for filename in ("/sys/fs/cgroup/memory.max","/sys/fs/cgroup/memory/memory.limit_in_bytes"):
+            limit = Scheduler.read_limit(filename)
+            if limit and limit[0].isdigit():
+                limits.append(int(limit[0]))
+        return min(limits) if limits else None
+
+    @staticmethod
+    def item_bytes(item):
+        values = item[-1]
+        if isinstance(values,tuple):
+            return len(values[0])
+        return getattr(values,"nbytes",0)
+
+    @staticmethod
+    def batch_reader(read_function,info,q,n,skip,batch,read_seconds):
+        items = []
+        start = time.perf_counter()
+        for item in Multi.read_items(read_function,info,skip):
+            items.append(item)
+            if len(items) >= batch.value:
+                # Running mean of read time per block, which the workers weigh against compute time
+                read_seconds.value = 0.8 * read_seconds.value + 0.2 * (time.perf_counter() - start) / len(items)
+                q.put(items)
+                items = []
+                start = time.perf_counter()
+        if items:
+            q.put(items)
+        for i in range(n):
+            q.put("DONE")
+        return None
+
+    @staticmethod
+    def batch_size(block_seconds,read_seconds,target_seconds,max_batch):
+        # Batches of about target_seconds of compute, and no more than the reader gets through in that time,
+        # so that a slow reader doesn't keep the workers waiting for whole batches
+        return int(min(max_batch,max(1,target_seconds / max(block_seconds,read_seconds,1e-6))))
+
+    @staticmethod
+    def mp_do_batches(q,f,info,o,block_seconds,read_seconds,batch,target_seconds,max_batch):
+        while True:
+            items = q.get()
+            if items == "DONE":
+                o.put("DONE")
+                break
+            for item in items:
+                start = time.perf_counter()
+                o.put(f(item,info))
+                seconds = time.perf_counter() - start
+                # Running mean of compute time per block sets the size of the next batches
+                with block_seconds.get_lock():
+                    block_seconds.value = 0.8 * block_seconds.value + 0.2 * seconds
+                    batch.value = Scheduler.batch_size(block_seconds.value,read_seconds.value,target_seconds,max_batch)
+        return None
+
+    def run(self,read_function,read_info,f,info,buffer_ratio=10,skip=None):
+        import multiprocessing
+        from functools import partial
+        cpus = self.available_cpus()
+        memory = self.available_memory()
+        skip = set(skip or ())
+        start = time.perf_counter()
+        compute_seconds = 0
+        read_seconds = 0
+        block_bytes = 0
+        n_serial = 0
+        items = Multi.read_items(read_function,read_info,skip)
+        read_start = time.perf_counter()
+        for item in items:
+            compute_start = time.perf_counter()
+            read_seconds += compute_start - read_start
+            result = f(item,info)
+            compute_seconds += time.perf_counter() - compute_start
+            block_bytes = max(block_bytes,self.item_bytes(item))
+            skip.add(item[0])
+            n_serial += 1
+            yield result
+            if cpus > 1 and time.perf_counter() - start > self.serial_seconds:
+                break
+            read_start = time.perf_counter()
+        else:
+            print(f"Scheduler: finished {n_serial} blocks in-process")
+            return None
+        items.close()
+        block_seconds = compute_seconds / n_serial
+        block_read_seconds = read_seconds / n_serial
+        # A single reader keeps about compute/read time per block workers busy; more would only wait for blocks
+        n_workers = max(1,min(cpus-1,int(np.ceil(block_seconds / max(block_read_seconds,1e-6)))))
+        size = self.batch_size(block_seconds,block_read_seconds,self.target_seconds,self.max_batch)
+        depth = max(2,buffer_ratio * n_workers // size)
+        if memory and block_bytes:
+            # Queued blocks are also decoded to float64 in the workers, so count them several times over
+            depth = max(1,min(depth,int(memory * self.memory_fraction / (8 * block_bytes * size))))
+        print(f"Scheduler: {cpus} CPUs, {n_workers} workers, {block_seconds*1000:.3g} ms per block, "
+              f"{block_read_seconds*1000:.3g} ms reading per block, batches of {size} blocks after {n_serial} blocks in-process")
+        batch = multiprocessing.Value('i',size)
+        shared_seconds = multiprocessing.Value('d',block_seconds)
+        shared_read_seconds = multiprocessing.Value('d',block_read_seconds,lock=False)
+        with multiprocessing.Manager() as manager:
+            q1 = manager.Queue(maxsize=depth)
+            q2 = manager.Queue()
+            pool = [multiprocessing.Process(target=Multi.guarded,
+                                            args=(Scheduler.mp_do_batches,q2,q1,f,info,q2,shared_seconds,shared_read_seconds,
+                                                  batch,self.target_seconds,self.max_batch))
+                    for i in range(n_workers)]
+            for p in pool:
+                p.start()
+            read_thread = Multi.reader_thread(read_function,read_info,q1,n_workers,skip,q2,
+                                              partial(Scheduler.batch_reader,batch=batch,read_seconds=shared_read_seconds))
+            done_count = 0
+            while True:
+                item = q2.get()
+                if isinstance(item,BaseException):
+                    raise item
+                if item == "DONE":
+                    done_count += 1
+                    if done_count == n_workers:
+                        break
+                    continue
+                yield item
+            read_thread.join()
+            for p in pool:
+                p.join()
+        print(f"Scheduler: {shared_seconds.value*1000:.3g} ms per block, {shared_read_seconds.value*1000:.3g} ms reading "
+              f"per block, final batches of {batch.value} blocks")
+
+#### SharedArray Class ####
+# numpy array in shared memory; it pickles as its name, so worker processes attach without copying the data
+class SharedArray:
+    def __init__(self,shape,dtype=float,name=None):
+        from multiprocessing import shared_memory
+        self.shape = tuple(shape)
+        self.dtype = np.dtype(dtype)
+        self.owner = name == None
+        if self.owner:
+            size = max(1,int(np.prod(self.shape)) * self.dtype.itemsize)
+            self.memory = shared_memory.SharedMemory(create=True,size=size)
+        else:
+            # Workers share the creator's resource tracker; only the creator unlinks the block
+            self.memory = shared_memory.SharedMemory(name=name)
+        self.array = np.ndarray(self.shape,dtype=self.dtype,buffer=self.memory.buf)
+
+    @staticmethod
+    def copy(array,rows=None):
+        array = np.asarray(array)
+        shape = array.shape if rows is None else (len(rows),) + array.shape[1:]
+        shared = SharedArray(shape,array.dtype)
+        if rows is None:
+            shared.array[...] = array
+        else:
+            np.take(array,rows,axis=0,out=shared.array)
+        return shared
+
+    def __getstate__(self):
+        return {"shape":self.shape,"dtype":self.dtype.str,"name":self.memory.name}
+
+    def __setstate__(self,state):
+        self.__init__(state["shape"],state["dtype"],state["name"])
+
+    def close(self):
+        self.array = None
+        self.memory.close()
+        if self.owner:
+            self.memory.unlink()
+
+#### ECDF Class ####
+# Empirical cdfs of many reference samples in one sorted key array: segment k holds the sorted values of
+# reference k, keyed (k << 32) | order-preserving float32 bits, so that a single searchsorted call
+# ranks every queried value within its own reference
+class ECDF:
+    @staticmethod
+    def sortable(values):
+        # float32 bit patterns as unsigned integers in the order of the values (-0.0 counts as 0.0)
+        bits = (np.asarray(values,dtype=np.float32) + np.float32(0)).view(np.uint32).astype(np.uint64)
+        return np.where(bits >> np.uint64(31),~bits & np.uint64(0xFFFFFFFF),bits | np.uint64(0x80000000))
+
+    @staticmethod
+    def keys(values,offsets):
+        segments = np.repeat(np.arange(len(offsets)-1,dtype=np.uint64),np.diff(offsets))
+        return (segments << np.uint64(32)) | ECDF.sortable(values)
+
+    @staticmethod
+    def tail(keys,offsets,segments,x,m):
+        # tail() from reference values: P(X <= x) below the median, P(X >= x) above it; segments, x and m broadcast
+        segments,x,m = np.broadcast_arrays(segments,x,m)
+        missing = np.isnan(x) | (segments < 0)
+        k = np.where(missing,0,segments)
+        start,n = offsets[k],offsets[k+1] - offsets[k]
+        query = (k.astype(np.uint64) << np.uint64(32)) | ECDF.sortable(np.where(missing,0,x))
+        below = np.searchsorted(keys,query,side="left") - start
+        upto = np.searchsorted(keys,query,side="right") - start
+        with np.errstate(invalid="ignore",divide="ignore"):
+            probabilities = np.where(x == m,1.0,np.where(x > m,(n - below) / n,upto / n))
+        probabilities[missing | (n == 0)] = np.nan
+        return probabilities
+
+#### RandomizedPCA Class ####
+# Sample PCA of a PS table from streaming row blocks. Each interval is centered on its mean and missing values
+# are imputed by that mean (so they add nothing); the top eigenvectors of the sample Gram matrix come from
+# randomized subspace iteration with one pass over the table per iteration, so memory depends on the number
+# of samples and the block size but not on the number of intervals
+class RandomizedPCA:
+    def __init__(self,n_components=10,passes=4,oversampling=10,seed=0):
+        self.n_components = n_components
+        self.passes = max(2,passes)
+        self.oversampling = oversampling
+        self.seed = seed
+
+    @staticmethod
+    def centered(values):
+        values = Table.decode(values.dense() if isinstance(values,SparseBlock) else values)
+        observed = ~np.isnan(values)
+        means = np.where(observed,values,0).sum(axis=1) / np.maximum(observed.sum(axis=1),1)
+        return np.where(observed,values - means[:,None],0)
+
+    def gram_product(self,blocks,basis):
+        # (X^T X) basis over all row blocks X, and the total variance trace(X^T X)
+        product = np.zeros(basis.shape)
+        total = 0.0
+        for values in blocks:
+            x = self.centered(values)
+            product += x.T @ (x @ basis)
+            total += float(np.einsum("ij,ij->",x,x))
+        return product,total
+
+    def fit(self,read_blocks,n_samples):
+        # read_blocks() starts a new pass over the table; returns sample scores and explained variance ratios
+        rng = np.random.default_rng(self.seed)
+        k = min(self.n_components,n_samples)
+        basis = np.linalg.qr(rng.standard_normal((n_samples,min(n_samples,k + self.oversampling))))[0]
+        for p in range(self.passes):
+            product,total = self.gram_product(read_blocks(),basis)
+            if p < self.passes - 1:
+                basis = np.linalg.qr(product)[0]
+        projected = basis.T @ product
+        eigenvalues,eigenvectors = np.linalg.eigh((projected + projected.T) / 2)
+        eigenvalues,eigenvectors = np.maximum(eigenvalues[::-1][:k],0),eigenvectors[:,::-1][:,:k]
+        vectors = basis @ eigenvectors
+        # Deterministic signs: the largest loading of each component is positive
+        vectors *= np.where(vectors[np.abs(vectors).argmax(axis=0),np.arange(k)] < 0,-1,1)
+        return vectors * np.sqrt(eigenvalues),eigenvalues / max(total,1e-300)
+
+#### Distance Class ####
+# Sample x sample Pearson or Euclidean distances over the intervals observed in both samples of each pair.
+# With values X (NaN as 0) and observed mask M, every row block adds M^T M, X^T X, (X*X)^T M and X^T M to
+# sums in shared memory; the sample axis is cut into tiles and each tile pair is added under its own lock
+class Distance:
+    metrics = ("pearson","euclidean")
+
+    def __init__(self,n_samples,metric="pearson",tile_size=1024):
+        import multiprocessing
+        self.n_samples = n_samples
+        self.metric = metric
+        self.bounds = list(range(0,n_samples,tile_size)) + [n_samples]
+        n_tiles = len(self.bounds) - 1
+        self.tiles = [(I,J) for I in range(n_tiles) for J in range(I,n_tiles)]
+        self.locks = [multiprocessing.Lock() for tile in self.tiles]
+        # counts, cross products, squares and (Pearson only) sums; rows are the weighted sample
+        self.sums = SharedArray((4 if metric == "pearson" else 3,n_samples,n_samples))
+        self.sums.array.fill(0)
+
+    def tile(self,I):
+        return slice(self.bounds[I],self.bounds[I+1])
+
+    def add(self,values):
+        values = Table.decode(values.dense() if isinstance(values,SparseBlock) else values)
+        observed = ~np.isnan(values)
+        x = np.where(observed,values,0)
+        m = observed.astype(float)
+        weighted = [x * x,x][:len(self.sums.array)-2]
+        for (I,J),lock in zip(self.tiles,self.locks):
+            a,b = self.tile(I),self.tile(J)
+            terms = [(0,a,b,m[:,a],m[:,b]),(1,a,b,x[:,a],x[:,b])]
+            for k,w in enumerate(weighted,2):
+                terms.append((k,a,b,w[:,a],m[:,b]))
+                if I != J:
+                    terms.append((k,b,a,w[:,b],m[:,a]))
+            for k,rows,columns,left,right in terms:
+                product = left.T @ right
+                with lock:
+                    self.sums.array[k,rows,columns] += product
+
+    def distances(self,n_rows):
+        # Distance matrix (float32, NaN for pairs without enough shared intervals) and pairwise observed counts
+        sums = self.sums.array
+        for I,J in self.tiles:
+            if I != J:
+                a,b = self.tile(I),self.tile(J)
+                sums[:2,b,a] = sums[:2,a,b].transpose(0,2,1)
+        distance = np.zeros((self.n_samples,self.n_samples),dtype=np.float32)
+        for I in range(len(self.bounds)-1):
+            a = self.tile(I)
+            counts = sums[0,a]
+            with np.errstate(divide="ignore",invalid="ignore"):
+                if self.metric == "euclidean":
+                    # Sums over shared intervals scaled up to all intervals, as in R's dist
+                    squared = np.maximum(sums[2,a] + sums[2,:,a].T - 2 * sums[1,a],0)
+                    tile = np.where(counts > 0,np.sqrt(squared * n_rows / counts),np.nan)
+                else:
+                    x,y = sums[3,a],sums[3,:,a].T
+                    covariance = counts * sums[1,a] - x * y
+                    variance = (counts * sums[2,a] - x * x) * (counts * sums[2,:,a].T - y * y)
+                    r = np.clip(covariance / np.sqrt(variance),-1,1)
+                    tile = np.where((counts > 1) & (variance > 0),1 - r,np.nan)
+            distance[a] = tile
+        diagonal = np.arange(self.n_samples)
+        distance[diagonal,diagonal] = np.where(np.isnan(distance[diagonal,diagonal]),np.nan,0)
+        return distance,sums[0].astype(np.int32)
+
+    def close(self):
+        self.sums.close()
+
+#### Contrasts Class ####
+# Rank-sum contrasts between manifest groups from a single sort of each row block
+class Contrasts:
+    def __init__(self,group_indices,n_samples,control=None,pairs=False):
+        self.names = list(group_indices.keys())
+        self.indices = [np.array(index) for index in group_indices.values()]
+        self.n_groups = len(self.names)
+        # Samples missing from the manifest get their own label so they still count as rest
+        self.labels = np.full(n_samples,self.n_groups)
+        for g,index in enumerate(self.indices):
+            self.labels[index] = g
+        self.pairs = []
+        if control in self.names:
+            c = self.names.index(control)
+            self.pairs.extend((g,c) for g in range(self.n_groups) if g != c)
+        if pairs:
+            for g in range(self.n_groups):
+                for h in range(g+1,self.n_groups):
+                    if (g,h) not in self.pairs and (h,g) not in self.pairs:
+                        self.pairs.append((g,h))
+        self.pair_names = [f"{self.names[g]}_vs_{self.names[h]}" for g,h in self.pairs]
+
+    @staticmethod
+    def sorted_median(ordered,cumulative,n):
+        n = n.astype(int)
+        low = np.argmax(cumulative > ((n-1)//2)[:,None],axis=1)
+        high = np.argmax(cumulative > (n//2)[:,None],axis=1)
+        rows = np.arange(len(n))
+        medians = (ordered[rows,low] + ordered[rows,high]) / 2
+        medians[n == 0] = np.nan
+        return medians
+
+    @staticmethod
+    def ranksum_pvals(u,n1,n2):
+        from scipy.special import ndtr
+        z = (u - n1*n2/2) / np.sqrt(n1*n2*(n1+n2+1)/12)
+        pvals = 2 * ndtr(-np.abs(z))
+        pvals[(n1 <= 2) | (n2 <= 2)] = np.nan
+        return pvals
+
+    def rank_block(self,values):
+        n_rows,n_samples = values.shape
+        n_labels = self.n_groups + 1
+        order = np.argsort(values,axis=1,kind='stable')
+        ordered = np.take_along_axis(values,order,axis=1)
+        labels = np.where(np.isnan(ordered),-1,self.labels[order])
+        valid = labels >= 0
+        # First and last position of each run of tied values
+        positions = np.arange(n_samples)
+        first = np.ones((n_rows,n_samples),dtype=bool)
+        first[:,1:] = ordered[:,1:] != ordered[:,:-1]
+        last = np.ones((n_rows,n_samples),dtype=bool)
+        last[:,:-1] = first[:,1:]
+        starts = np.maximum.accumulate(np.where(first,positions,0),axis=1)
+        ends = np.minimum.accumulate(np.where(last,positions,n_samples-1)[:,::-1],axis=1)[:,::-1]
+        bins = (np.arange(n_rows)[:,None] * n_labels + labels)[valid]
+        valid_cumulative = np.cumsum(valid,axis=1)
+        n_valid = valid_cumulative[:,-1] if n_samples else np.zeros(n_rows)
+        counts = np.zeros((n_rows,n_labels))
+        medians = np.full((n_rows,n_labels),np.nan)
+        rest_medians = np.full((n_rows,self.n_groups),np.nan)
+        # u[r,g,h]: Mann-Whitney U of group g against group h
+        u = np.zeros((n_rows,n_labels,n_labels))
+        cumulative = np.zeros((n_rows,n_samples+1))
+        for h in range(n_labels):
+            cumulative[:,1:] = np.cumsum(labels == h,axis=1)
+            less = np.take_along_axis(cumulative,starts,axis=1)
+            equal = np.take_along_axis(cumulative,ends+1,axis=1) - less
+            u[:,:,h] = np.bincount(bins,weights=(less + 0.5*equal)[valid],
+                                   minlength=n_rows*n_labels).reshape(n_rows,n_labels)
+            counts[:,h] = cumulative[:,-1]
+            medians[:,h] = self.sorted_median(ordered,cumulative[:,1:],counts[:,h])
+            if h < self.n_groups:
+                rest_medians[:,h] = self.sorted_median(ordered,valid_cumulative - cumulative[:,1:],n_valid - counts[:,h])
+        return counts,medians,rest_medians,u
+
+    @staticmethod
+    def segment_median(ordered,member,n):
+        # Medians of the selected values of each row, from values sorted within rows
+        selected = ordered[member]
+        n = n.astype(int)
+        offsets = np.cumsum(n) - n
+        medians = np.full(len(n),np.nan)
+        has = n > 0
+        medians[has] = (selected[offsets[has] + (n[has]-1)//2] + selected[offsets[has] + n[has]//2]) / 2
+        return medians
+
+    def medians(self,values):
+        # Group and rest medians only, from one sort of each row (the exact medians of compare())
+        if isinstance(values,SparseBlock):
+            rows = values.row_ids()
+            order = np.lexsort((values.data,rows))
+            ordered,labels = values.data[order],self.labels[values.indices[order]]
+            n_valid = np.diff(values.indptr)
+            counts = lambda member: np.bincount(rows,weights=member,minlength=len(values))
+        else:
+            order = np.argsort(values,axis=1,kind='stable')
+            ordered = np.take_along_axis(values,order,axis=1)
+            labels = np.where(np.isnan(ordered),-1,self.labels[order])
+            n_valid = (labels >= 0).sum(axis=1)
+            counts = lambda member: member.sum(axis=1)
+        medians = np.full((len(values),self.n_groups),np.nan)
+        rest_medians = np.full((len(values),self.n_groups),np.nan)
+        for h in range(self.n_groups):
+            member = labels == h
+            n = counts(member)
+            medians[:,h] = self.segment_median(ordered,member,n)
+            rest_medians[:,h] = self.segment_median(ordered,(labels >= 0) & ~member,n_valid - n)
+        return medians,rest_medians
+
+    def rank_sparse(self,block):
+        # rank_block() over the observed entries of a SparseBlock, with rows as segments of one sorted array
+        n_rows = len(block)
+        n_labels = self.n_groups + 1
+        rows = block.row_ids()
+        order = np.lexsort((block.data,rows))
+        ordered = block.data[order]
+        labels = self.labels[block.indices[order]]
+        n = len(ordered)
+        positions = np.arange(n)
+        first = np.ones(n,dtype=bool)
+        first[1:] = (ordered[1:] != ordered[:-1]) | (rows[1:] != rows[:-1])
+        last = np.ones(n,dtype=bool)
+        last[:-1] = first[1:]
+        starts = np.maximum.accumulate(np.where(first,positions,0)) if n else positions
+        ends = np.minimum.accumulate(np.where(last,positions,n-1)[::-1])[::-1] if n else positions
+        row_starts = block.indptr[rows]
+        bins = rows * n_labels + labels
+        n_valid = np.diff(block.indptr)
+        counts = np.zeros((n_rows,n_labels))
+        medians = np.full((n_rows,n_labels),np.nan)
+        rest_medians = np.full((n_rows,self.n_groups),np.nan)
+        u = np.zeros((n_rows,n_labels,n_labels))
+        cumulative = np.zeros(n+1)
+        for h in range(n_labels):
+            member = labels == h
+            cumulative[1:] = np.cumsum(member)
+            less = cumulative[starts] - cumulative[row_starts]
+            equal = cumulative[ends+1] - cumulative[starts]
+            u[:,:,h] = np.bincount(bins,weights=less + 0.5*equal,minlength=n_rows*n_labels).reshape(n_rows,n_labels)
+            counts[:,h] = cumulative[block.indptr[1:]] - cumulative[block.indptr[:-1]]
+            medians[:,h] = self.segment_median(ordered,member,counts[:,h])
+            if h < self.n_groups:
+                rest_medians[:,h] = self.segment_median(ordered,~member,n_valid - counts[:,h])
+        return counts,medians,rest_medians,u
+
+    def rank_z(self,ranks,valid,members):
+        # Standardized rank sums of each group for a batch of label assignments (batch x samples x groups)
+        n_batch,n_samples,n_groups = members.shape
+        members = members.transpose(1,0,2).reshape(n_samples,n_batch*n_groups)
+        w = (ranks @ members).reshape(-1,n_batch,n_groups)
+        n1 = (valid @ members).reshape(-1,n_batch,n_groups)
+        n = valid.sum(axis=1)[:,None,None]
+        n2 = n - n1
+        return (w - n1*(n+1)/2) / np.sqrt(n1*n2*(n+1)/12)
+
+    def permutation_pvals(self,values,threshold=0.05,n_permutations=10000,seed=0,confidence=0.999,batch_size=200):
+        from scipy.stats import rankdata
+        from scipy.special import betaincinv
+        n_rows,n_samples = values.shape
+        valid = (~np.isnan(values)).astype(float)
+        ranks = np.nan_to_num(rankdata(values,axis=1,nan_policy='omit'))
+        onehot = (self.labels[:,None] == np.arange(self.n_groups)).astype(float)
+        observed = np.abs(self.rank_z(ranks,valid,onehot[None])[:,0,:])
+        active = ~np.isnan(observed)
+        exceed = np.zeros((n_rows,self.n_groups))
+        done = np.zeros((n_rows,self.n_groups))
+        # Every block draws the same permutation stream, so results don't depend on blocking
+        rng = np.random.default_rng(seed)
+        batch_size = max(10,min(batch_size,int(2e7 // max(1,n_samples*self.n_groups))))
+        base = np.tile(np.arange(n_samples),(batch_size,1))
+        b = 0
+        while b < n_permutations and active.any():
+            batch = min(batch_size,n_permutations-b)
+            members = onehot[rng.permuted(base[:batch],axis=1)]
+            rows = np.flatnonzero(active.any(axis=1))
+            z = np.abs(self.rank_z(ranks[rows],valid[rows],members))
+            exceed[rows] += (z >= observed[rows,None,:] - 1e-9).sum(axis=1) * active[rows]
+            done[rows] += batch * active[rows]
+            b += batch
+            # Stop once the p-value is confidently above threshold
+            lower = np.zeros_like(exceed)
+            hits = exceed > 0
+            lower[hits] = betaincinv(exceed[hits],done[hits]-exceed[hits]+1,(1-confidence)/2)
+            active &= lower <= threshold
+        pvals = (exceed+1) / (done+1)
+        pvals[np.isnan(observed)] = np.nan
+        return pvals
+
+    def compare(self,values,test="ranksum",**permutation_options):
+        groups = np.arange(self.n_groups)
+        if isinstance(values,SparseBlock):
+            counts,medians,rest_medians,u = self.rank_sparse(values)
+            n_labels = self.n_groups + 1
+            sums = np.bincount(values.row_ids()*n_labels + self.labels[values.indices],weights=values.data,
+                               minlength=len(values)*n_labels).reshape(len(values),n_labels)
+            means = sums[:,:self.n_groups] / counts[:,:self.n_groups]
+        else:
+            counts,medians,rest_medians,u = self.rank_block(values)
+            means = np.stack([np.nanmean(values[:,index],axis=1) for index in self.indices],axis=1)
+        n1 = counts[:,:self.n_groups]
+        n2 = counts.sum(axis=1)[:,None] - n1
+        u_rest = u[:,groups,:].sum(axis=2) - u[:,groups,groups]
+        if test == "permutation":
+            dense = values.dense() if isinstance(values,SparseBlock) else values
+            pvals = self.permutation_pvals(dense,**permutation_options)
+        else:
+            pvals = self.ranksum_pvals(u_rest,n1,n2)
+        deltas = medians[:,:self.n_groups] - rest_medians
+        pair_deltas = np.zeros((len(values),len(self.pairs)))
+        pair_pvals = np.zeros((len(values),len(self.pairs)))
+        for k,(g,h) in enumerate(self.pairs):
+            pair_deltas[:,k] = medians[:,g] - medians[:,h]
+            pair_pvals[:,k] = self.ranksum_pvals(u[:,g,h],counts[:,g],counts[:,h])
+        return medians[:,:self.n_groups],means,deltas,pvals,pair_deltas,pair_pvals
+
+#### Catalog Class ####
+# Interned splice intervals: each "contig:left-right:strand" name gets a stable int64 ID (its position in
+# records) so that tables, stats and queues carry integers, and names are only formatted for output
+class Catalog:
+    record_dtype = np.dtype([("contig",np.int32),("left",np.int64),("right",np.int64),("strand","S1")])
+
+    def __init__(self):
+        self.contigs = []
+        self.contig_ids = {}
+        self.ids = {}
+        # records is a view of the first len(self) entries of a buffer that grows by doubling, since
+        # tables add their names a row block at a time
+        self.buffer = np.zeros(1024,dtype=self.record_dtype)
+        self.records = self.buffer[:0]
+        # Names that don't have the contig:left-right:strand form are kept as they are
+        self.names = {}
+
+    def __len__(self):
+        return len(self.records)
+
+    def parse(self,name,i):
+        # The whole name is checked before its contig is registered, so that contig_ids and contigs stay aligned
+        try:
+            contig,span,strand = name.rsplit(":",2)
+            left,right = span.split("-")
+            left,right = int(left),int(right)
+            if f"{contig}:{left}-{right}:{strand}" == name and len(strand.encode()) == 1:
+                if contig not in self.contig_ids:
+                    self.contig_ids[contig] = len(self.contigs)
+                    self.contigs.append(contig)
+                return (self.contig_ids[contig],left,right,strand.encode())
+        except ValueError:
+            pass
+        self.names[i] = name
+        return (-1,0,0,b"")
+
+    def add(self,names):
+        ids = np.empty(len(names),dtype=np.int64)
+        new = []
+        for k,name in enumerate(names):
+            i = self.ids.get(name)
+            if i == None:
+                i = len(self.records) + len(new)
+                self.ids[name] = i
+                new.append(self.parse(name,i))
+            ids[k] = i
+        if new:
+            n = len(self.records)
+            if n + len(new) > len(self.buffer):
+                self.buffer = np.concatenate([self.records,np.zeros(max(n,len(new)),dtype=self.record_dtype)])
+            self.buffer[n:n+len(new)] = new
+            self.records = self.buffer[:n+len(new)]
+        return ids
+
+    def clusters(self,ids):
+        # Cluster labels joining intervals that overlap (directly or through a chain) on the same contig and
+        # strand; names without coordinates are clusters of their own
+        records = self.records[np.asarray(ids,dtype=np.int64)]
+        keys = records["contig"].astype(np.int64) * 256 + records["strand"].view(np.uint8)
+        parsed = records["contig"] >= 0
+        keys[~parsed] = keys.max(initial=0) + 1 + np.arange((~parsed).sum())
+        # Offsetting each contig and strand past the previous one lets one running maximum cover all of them
+        span = int(records["right"].max(initial=0)) + 2
+        offset = np.unique(keys,return_inverse=True)[1].astype(np.int64) * span
+        left,right = records["left"] + offset,records["right"] + offset
+        order = np.lexsort((left,offset))
+        reach = np.maximum.accumulate(right[order])
+        starts = np.ones(len(order),dtype=bool)
+        starts[1:] = left[order][1:] > reach[:-1]
+        labels = np.empty(len(order),dtype=np.int64)
+        labels[order] = np.cumsum(starts) - 1
+        return labels
+
+    def format(self,ids):
+        ids = np.asarray(ids,dtype=np.int64)
+        contigs = self.contigs
+        return [self.names[i] if c < 0 else f"{contigs[c]}:{left}-{right}:{strand.decode()}"
+                for i,(c,left,right,strand) in zip(ids.tolist(),self.records[ids].tolist())]
+
 #### Table Class ####        
 class Table:
-    def __init__(self,filename=None,samples=None,intervals=None,data=None,store=None):
+    # Quantized PS storage: x -> round(x*65534), NaN -> 65535
+    quantized_scale = 65534
+    quantized_nan = 65535
+
+    def __init__(self,filename=None,samples=None,intervals=None,data=None,store=None,block_size=256,dtype=None,sparse=False):
         self.store = store
+        self.block_size = block_size
+        self.sparse = sparse
+        self.catalog = None
         if intervals and samples and data:
             self.samples = samples
             self.intervals = intervals
             self.data = data
+            self.ids = None
         else:
             self.filename = filename
             self.samples = None
             self.intervals = None
             self.data = None
+            self.ids = None
+            if store == None and filename and filename.endswith(".csr.npz"):
+                self.store = "csr"
+                self.sparse = True
+            elif store == None and filename and filename.endswith(".npy"):
+                self.store = "npy"
+        # Blocks keep the type of a binary store unless another is asked for
+        self.dtype = dtype or (self.source_dtype().name if self.store else "float64")
+
+    @staticmethod
+    def encode(values,dtype):
+        if dtype == "uint16":
+            values = np.asarray(values,dtype=float)
+            quantized = np.rint(np.clip(values,0,1) * Table.quantized_scale)
+            quantized[np.isnan(values)] = Table.quantized_nan
+            return quantized.astype(np.uint16)
+        return np.asarray(values,dtype=dtype)
+
+    @staticmethod
+    def decode(values):
+        if isinstance(values,SparseBlock):
+            return values.decode()
+        if values.dtype == np.uint16:
+            decoded = values / Table.quantized_scale
+            decoded[values == Table.quantized_nan] = np.nan
+            return decoded
+        return values.astype(float,copy=False)
+
+    def source_dtype(self):
+        # Type of the values in the file, before get_blocks encodes them to self.dtype (TSV text parses to float64)
+        if self.store == "npy":
+            return np.load(self.filename,mmap_mode='r').dtype
+        if self.store == "csr":
+            with np.load(self.filename) as csr, csr.zip.open("data.npy") as data:
+                version = np.lib.format.read_magic(data)
+                header = np.lib.format.read_array_header_1_0 if version == (1,0) else np.lib.format.read_array_header_2_0
+                return header(data)[2]
+        return np.dtype(float)
+
+    @staticmethod
+    def index_filename(filename):
+        return f"{filename[:-4]}.intervals.tsv"
 
     def get_samples(self):
         if self.samples:
             return self.samples
+        elif self.store in ("npy","csr"):
+            with open(self.index_filename(self.filename)) as tsv:
+                return tsv.readline().rstrip('\n').split('\t')[1:]
         else:
             with open(self.filename) as tsv:
                 return tsv.readline().rstrip().split('\t')[1:]
+
+    def get_intervals(self):
+        if self.store in ("npy","csr"):
+            with open(self.index_filename(self.filename)) as tsv:
+                tsv.readline()
+                return [line.rstrip('\n') for line in tsv]
+        lines = self.prefetch_lines(self.filename)
+        next(lines)
+        return [line[:line.find(b"\t")].decode() for line in lines if line]
+
+    def register(self,catalog):
+        # Blocks carry catalog IDs instead of interval names; TSV rows are interned as they are read
+        self.catalog = catalog
+        self.ids = None
+
+    def get_ids(self):
+        # IDs of all rows (catalog IDs of a registered table, else row numbers)
+        if self.ids is None:
+            intervals = self.get_intervals()
+            self.ids = self.catalog.add(intervals) if self.catalog is not None else np.arange(len(intervals),dtype=np.int64)
+        return self.ids
             
     def get_rows(self,interval_set=None):
         if self.store == None:
@@ -122,7 +1114,415 @@ class Table:
                         interval,row = line.rstrip().split("\t",1)
                         if interval in interval_set:
                             yield (interval,[float(x) for x in row.split('\t')])
+        elif self.store == "npy":
+            data = np.load(self.filename,mmap_mode='r')
+            for r,interval in enumerate(self.get_intervals()):
+                if interval_set == None or interval in interval_set:
+                    yield (interval,self.decode(np.asarray(data[r])).tolist())
+        elif self.store == "csr":
+            with np.load(self.filename) as csr:
+                indptr,indices,data = csr["indptr"],csr["indices"],csr["data"]
+                n_samples = int(csr["n_samples"])
+            for r,interval in enumerate(self.get_intervals()):
+                if interval_set == None or interval in interval_set:
+                    row = SparseBlock.take_rows(indptr,indices,data,[r],n_samples)
+                    yield (interval,row.decode().dense()[0].tolist())
+
+    @staticmethod
+    def load(values):
+        # TSV blocks from get_blocks arrive as raw bytes and are parsed in the worker processes
+        if not isinstance(values,tuple):
+            return values
+        data,n_rows,dtype,sparse = values
+        with warnings.catch_warnings():
+            warnings.simplefilter("ignore",DeprecationWarning)
+            parsed = np.fromstring(data,sep=" ")
+        if len(parsed) % n_rows:
+            parsed = np.array(data.split(),dtype=float)
+        values = Table.encode(parsed.reshape(n_rows,-1),dtype)
+        return SparseBlock.from_dense(values) if sparse else values
+
+    @staticmethod
+    def prefetch_lines(filename,chunk_bytes=1<<24,depth=4):
+        # Lines of a file as bytes, read ahead in large chunks by a background thread
+        import queue
+        import threading
+        chunks = queue.Queue(maxsize=depth)
+        def read_ahead():
+            with open(filename,'rb') as data_file:
+                chunk = True
+                while chunk:
+                    chunk = data_file.read(chunk_bytes)
+                    chunks.put(chunk)
+        threading.Thread(target=read_ahead,daemon=True).start()
+        rest = b""
+        chunk = chunks.get()
+        while chunk:
+            lines = (rest + chunk).split(b"\n")
+            rest = lines.pop()
+            yield from lines
+            chunk = chunks.get()
+        if rest:
+            yield rest
+
+    def get_blocks(self,interval_set=None,skip=None):
+        # Blocks of (number, interval IDs, values); interval_set holds IDs, and blocks
+        # are numbered in table order with blocks in skip counted but not read
+        wanted = None if interval_set is None else np.fromiter(interval_set,dtype=np.int64,count=len(interval_set))
+        if self.store in ("npy","csr"):
+            ids = self.get_ids()
+            keep = None if wanted is None else np.isin(ids,wanted)
+            if self.store == "npy":
+                data = np.load(self.filename,mmap_mode='r')
+            else:
+                with np.load(self.filename) as csr:
+                    indptr,indices,data = csr["indptr"],csr["indices"],csr["data"]
+                    n_samples = int(csr["n_samples"])
+            rows = np.arange(len(ids)) if keep is None else np.flatnonzero(keep)
+            for i,start in enumerate(range(0,len(rows),self.block_size)):
+                if skip and i in skip:
+                    continue
+                index = rows[start:start+self.block_size]
+                if self.store == "csr":
+                    values = SparseBlock.take_rows(indptr,indices,data,index,n_samples)
+                    if values.dtype != np.dtype(self.dtype):
+                        values.data = self.encode(self.decode(values).data,self.dtype)
+                else:
+                    values = np.asarray(data[index])
+                    if values.dtype != np.dtype(self.dtype):
+                        values = self.encode(self.decode(values),self.dtype)
+                    if self.sparse:
+                        values = SparseBlock.from_dense(values)
+                yield (i,ids[index],values)
+            return None
+        # TSV rows get their IDs in the same pass: a full read interns the names of every block in table
+        # order (skipped blocks too, so that a resumed run assigns the same IDs), and a read of an
+        # interval_set looks the names up, since rows that aren't in the catalog can't be wanted
+        wanted = None if wanted is None else set(wanted.tolist())
+        known = self.catalog.ids if self.catalog is not None else None
+        def block_ids(index,names):
+            return self.catalog.add(names) if names else np.array(index,dtype=np.int64)
+        lines = self.prefetch_lines(self.filename)
+        next(lines)
+        index = []
+        names = []
+        rows = []
+        i = 0
+        r = -1
+        for line in lines:
+            if not line:
+                continue
+            r += 1
+            tab = line.find(b"\t")
+            if known is None:
+                if wanted is not None and r not in wanted:
+                    continue
+                index.append(r)
+            elif wanted is None:
+                names.append(line[:tab].decode())
+            else:
+                row_id = known.get(line[:tab].decode(),-1)
+                if row_id not in wanted:
+                    continue
+                index.append(row_id)
+            rows.append(line[tab+1:])
+            if len(rows) == self.block_size:
+                ids = block_ids(index,names)
+                if not skip or i not in skip:
+                    yield (i,ids,(b"\n".join(rows),len(rows),self.dtype,self.sparse))
+                index = []
+                names = []
+                rows = []
+                i += 1
+        if rows:
+            ids = block_ids(index,names)
+            if not skip or i not in skip:
+                yield (i,ids,(b"\n".join(rows),len(rows),self.dtype,self.sparse))
+
+    def write_store(self,output_prefix,dtype="float32"):
+        if self.sparse:
+            return self.write_sparse_store(output_prefix,dtype)
+        from numpy.lib.format import open_memmap
+        samples = self.get_samples()
+        with open(self.filename) as tsv:
+            n_rows = sum(1 for line in tsv) - 1
+        filename = f"{output_prefix}.ps.npy"
+        data = open_memmap(filename,mode='w+',dtype=np.uint16 if dtype == "uint16" else dtype,shape=(n_rows,len(samples)))
+        tab = '\t'
+        intervals = self.get_intervals()
+        with open(self.index_filename(filename),'w') as index:
+            index.write(f"splice_interval\t{tab.join(samples)}\n")
+            start = 0
+            store_dtype,self.dtype = self.dtype,dtype
+            for i,ids,values in self.get_blocks():
+                values = self.load(values)
+                data[start:start+len(values)] = values
+                index.write("".join(f"{interval}\n" for interval in intervals[start:start+len(values)]))
+                start += len(values)
+            self.dtype = store_dtype
+        data.flush()
+        return filename
+
+    def write_sparse_store(self,output_prefix,dtype="float32"):
+        # Observed values only, as one CSR matrix in {prefix}.ps.csr.npz
+        samples = self.get_samples()
+        filename = f"{output_prefix}.ps.csr.npz"
+        store_dtype,self.dtype = self.dtype,dtype
+        blocks = [self.load(values) for i,ids,values in self.get_blocks()]
+        self.dtype = store_dtype
+        lengths = np.concatenate([np.zeros(0,dtype=np.int64)] + [np.diff(block.indptr) for block in blocks])
+        indptr = np.zeros(len(lengths)+1,dtype=np.int64)
+        indptr[1:] = np.cumsum(lengths)
+        np.savez(filename,indptr=indptr,
+                 indices=np.concatenate([np.zeros(0,dtype=np.int32)] + [block.indices for block in blocks]),
+                 data=np.concatenate([Table.encode(np.zeros(0),dtype)] + [block.data for block in blocks]),
+                 n_samples=len(samples))
+        tab = '\t'
+        with open(self.index_filename(filename),'w') as index:
+            index.write(f"splice_interval\t{tab.join(samples)}\n")
+            index.write("".join(f"{interval}\n" for interval in self.get_intervals()))
+        return filename
+
+#### SparseBlock Class ####
+# Observed (non-NaN) values of a row block in CSR form: row r has values data[indptr[r]:indptr[r+1]]
+# for the samples in indices[indptr[r]:indptr[r+1]], in sample order
+class SparseBlock:
+    def __init__(self,indptr,indices,data,n_samples):
+        self.indptr = indptr
+        self.indices = indices
+        self.data = data
+        self.n_samples = n_samples
+
+    def __len__(self):
+        return len(self.indptr) - 1
+
+    @property
+    def dtype(self):
+        return self.data.dtype
+
+    @property
+    def nbytes(self):
+        return self.indptr.nbytes + self.indices.nbytes + self.data.nbytes
+
+    @staticmethod
+    def from_dense(values):
+        observed = ~np.isnan(Table.decode(values))
+        rows,indices = np.nonzero(observed)
+        indptr = np.zeros(len(values)+1,dtype=np.int64)
+        indptr[1:] = np.cumsum(observed.sum(axis=1))
+        return SparseBlock(indptr,indices.astype(np.int32),values[rows,indices],values.shape[1])
+
+    @staticmethod
+    def take_rows(indptr,indices,data,rows,n_samples):
+        rows = np.asarray(rows,dtype=np.int64)
+        lengths = indptr[rows+1] - indptr[rows]
+        block_indptr = np.zeros(len(rows)+1,dtype=np.int64)
+        block_indptr[1:] = np.cumsum(lengths)
+        # Positions of each row's entries in the full arrays
+        gather = np.repeat(indptr[rows] - block_indptr[:-1],lengths) + np.arange(block_indptr[-1])
+        return SparseBlock(block_indptr,indices[gather],data[gather],n_samples)
+
+    def row_ids(self):
+        return np.repeat(np.arange(len(self)),np.diff(self.indptr))
+
+    def take(self,rows):
+        return SparseBlock.take_rows(self.indptr,self.indices,self.data,rows,self.n_samples)
+
+    def decode(self):
+        return SparseBlock(self.indptr,self.indices,Table.decode(self.data),self.n_samples)
+
+    def dense(self):
+        values = np.full((len(self),self.n_samples),np.nan)
+        values[self.row_ids(),self.indices] = Table.decode(self.data)
+        return values
+
+    def select(self,samples):
+        # Entries of the given samples (sorted sample indices), as a block over those samples
+        position = np.full(self.n_samples,-1)
+        position[samples] = np.arange(len(samples))
+        keep = position[self.indices] >= 0
+        indptr = np.zeros(len(self)+1,dtype=np.int64)
+        indptr[1:] = np.cumsum(np.bincount(self.row_ids()[keep],minlength=len(self)))
+        return SparseBlock(indptr,position[self.indices[keep]].astype(np.int32),self.data[keep],len(samples))
                         
+#### Checkpoint Class ####
+# Finished blocks of a stage are appended to {prefix}.{stage}.partial; the .checkpoint.json manifest
+# records the input fingerprint, the completed block ranges and how much of the partial file is valid.
+class Checkpoint:
+    def __init__(self,output_prefix,stage,fingerprint,resume=False,interval=300):
+        self.stage = stage
+        self.partial_file = f"{output_prefix}.{stage}.partial"
+        self.manifest_file = f"{output_prefix}.{stage}.checkpoint.json"
+        self.fingerprint = fingerprint
+        self.interval = interval
+        self.results = {}
+        self.pending = []
+        self.complete = False
+        # Whether the partial file holds results, i.e. a flush happened or a checkpoint was resumed
+        self.flushed = False
+        self.last_flush = time.time()
+        if resume:
+            self.load()
+        else:
+            self.remove()
+
+    @staticmethod
+    def get_fingerprint(filenames,settings):
+        import hashlib
+        import json
+        fingerprint = hashlib.sha256(json.dumps(settings,sort_keys=True,default=str).encode())
+        for filename in filenames:
+            if filename:
+                stat = os.stat(filename)
+                fingerprint.update(f"{os.path.abspath(filename)}\t{stat.st_size}\t{stat.st_mtime_ns}".encode())
+                with open(filename,'rb') as data:
+                    fingerprint.update(data.read(1<<20))
+        return fingerprint.hexdigest()
+
+    def load(self):
+        import json
+        import pickle
+        if not os.path.exists(self.manifest_file):
+            return None
+        with open(self.manifest_file) as manifest_file:
+            manifest = json.load(manifest_file)
+        if manifest["fingerprint"] != self.fingerprint:
+            print(f"Checkpoint for {self.stage} does not match the inputs, starting over.")
+            self.remove()
+            return None
+        with open(self.partial_file,'r+b') as partial:
+            partial.truncate(manifest["offset"])
+            while partial.tell() < manifest["offset"]:
+                i,result = pickle.load(partial)
+                self.results[i] = result
+        self.complete = manifest["complete"]
+        self.flushed = True
+        print(f"Resuming {self.stage} with {len(self.results)} finished blocks.")
+
+    def done(self):
+        return set(self.results.keys())
+
+    def add(self,i,result):
+        self.results[i] = result
+        self.pending.append(i)
+        if self.interval and time.time() - self.last_flush > self.interval:
+            self.flush()
+
+    def ranges(self):
+        ranges = []
+        for i in sorted(self.results):
+            if ranges and ranges[-1][1] == i-1:
+                ranges[-1][1] = i
+            else:
+                ranges.append([i,i])
+        return ranges
+
+    def flush(self,complete=False):
+        import json
+        import pickle
+        if not self.interval:
+            return None
+        with open(self.partial_file,'ab') as partial:
+            for i in self.pending:
+                pickle.dump((i,self.results[i]),partial)
+            partial.flush()
+            os.fsync(partial.fileno())
+            offset = partial.tell()
+        self.pending = []
+        manifest = {"fingerprint":self.fingerprint,"complete":complete,
+                    "offset":offset,"chunks":self.ranges()}
+        with open(f"{self.manifest_file}.tmp",'w') as manifest_file:
+            json.dump(manifest,manifest_file)
+        os.replace(f"{self.manifest_file}.tmp",self.manifest_file)
+        self.flushed = True
+        self.last_flush = time.time()
+
+    def close(self):
+        # A stage that finished before its first flush is not saved: redoing it costs less than an interval
+        self.complete = True
+        if self.flushed:
+            self.flush(complete=True)
+        return [self.results[i] for i in sorted(self.results)]
+
+    def remove(self):
+        for filename in (self.partial_file,self.manifest_file):
+            if os.path.exists(filename):
+                os.remove(filename)
+
+#### TSV Class ####
+# Bulk readers and writers for .sig/.beta/.pvals style tables, streamed in chunks of rows
+class TSV:
+    @staticmethod
+    def stat_header(groups,stats):
+        return [f"{stat}_{group}" for group in groups for stat in stats]
+
+    @staticmethod
+    def stat_columns(header):
+        # "{stat}_{group}" columns -> groups, stats and a (groups x stats) array of column positions
+        groups,stats = {},{}
+        for column in header:
+            stat,group = column.split("_",1)
+            groups.setdefault(group,len(groups))
+            stats.setdefault(stat,len(stats))
+        index = np.full((len(groups),len(stats)),-1)
+        for i,column in enumerate(header):
+            stat,group = column.split("_",1)
+            index[groups[group],stats[stat]] = i
+        return list(groups),list(stats),index
+
+    @staticmethod
+    def read_header(filename):
+        with open(filename) as tsv:
+            return tsv.readline().rstrip('\n').split('\t')
+
+    @staticmethod
+    def read_chunks(filename,usecols=None,chunk_size=65536):
+        # Only the columns in usecols (default: all but the first) are converted
+        import io
+        from itertools import islice
+        with open(filename,'rb') as tsv:
+            header = tsv.readline().rstrip(b'\n').decode().split('\t')
+            if usecols == None:
+                usecols = range(1,len(header))
+            while True:
+                lines = list(islice(tsv,chunk_size))
+                if not lines:
+                    break
+                names = [line[:line.find(b'\t')].decode() for line in lines]
+                text = b"".join(lines).replace(b"None",b"nan")
+                values = np.loadtxt(io.BytesIO(text),delimiter='\t',usecols=usecols,ndmin=2,dtype=float)
+                yield names,values
+
+    @staticmethod
+    def read_stats(filename,stats,chunk_size=65536):
+        # Yields groups,names,(rows x groups x stats) arrays for the requested stats
+        groups,found,index = TSV.stat_columns(TSV.read_header(filename)[1:])
+        columns = index[:,[found.index(stat) for stat in stats]] + 1
+        for names,values in TSV.read_chunks(filename,columns.ravel().tolist(),chunk_size):
+            yield groups,names,values.reshape(len(names),len(groups),len(stats))
+
+    @staticmethod
+    def row_format(n_columns,precision=None):
+        number = "%r" if precision == None else f"%.{precision}g"
+        return "%s" + f"\t{number}" * n_columns + "\n"
+
+    @staticmethod
+    def write_chunks(filename,header,chunks,precision=None):
+        tab = '\t'
+        row_format = TSV.row_format(len(header)-1,precision)
+        with open(filename,'w') as tsv:
+            tsv.write(f"{tab.join(header)}\n")
+            for names,values in chunks:
+                values = np.asarray(values,dtype=float).reshape(len(names),-1).tolist()
+                tsv.write("".join([row_format % (name,*row) for name,row in zip(names,values)]))
+
+    @staticmethod
+    def chunked(names,get_values,chunk_size=65536,format_names=None):
+        names = list(names)
+        for start in range(0,len(names),chunk_size):
+            chunk = names[start:start+chunk_size]
+            yield (format_names(chunk) if format_names else chunk),get_values(chunk)
+
 #### Annotation class ####
 class Annotation:
     def __init__(self,gtf_filename):